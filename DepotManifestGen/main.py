@@ -1,22 +1,34 @@
 import vdf
+import json
+import time
 import gevent
 import struct
+import hashlib
 import os.path
 import logging
+import sqlite3
 import argparse
 import traceback
+import multiprocessing
 from pathlib import Path
+from gevent.pool import Pool
+from threading import Lock
+from io import BytesIO
 from binascii import crc32
-from steam.core.cm import CMClient
+from operator import attrgetter
+from zipfile import ZipFile, ZIP_DEFLATED
+from steam.core.cm import CMClient, CMServerList
 from steam.client import SteamClient
 from six import itervalues, iteritems
 from steam.client.cdn import CDNClient
 from steam.enums import EResult, EType
 from steam.exceptions import SteamError
-from steam.protobufs.content_manifest_pb2 import ContentManifestSignature
+from steam.core.manifest import DepotManifest
+from concurrent.futures import ProcessPoolExecutor
+from steam.protobufs.content_manifest_pb2 import ContentManifestSignature, ContentManifestMetadata
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-u', '--username', required=True)
+parser.add_argument('-u', '--username', required=False)
 parser.add_argument('-p', '--password', required=False, default='')
 parser.add_argument('-a', '--app-id', required=False)
 parser.add_argument('-l', '--list-apps', action='store_true', required=False)
@@ -30,6 +42,13 @@ parser.add_argument('-L', '--level', required=False, default='INFO')
 parser.add_argument('-C', '--credential-location', required=False)
 parser.add_argument('-r', '--remove-old', action='store_true', required=False)
 parser.add_argument('-n', '--retry', type=int, required=False, default=1)
+parser.add_argument('-P', '--process-num', type=int, required=False)
+parser.add_argument('-K', '--key-store', required=False)
+parser.add_argument('-b', '--batch', required=False)
+parser.add_argument('-j', '--concurrency', type=int, required=False, default=4)
+parser.add_argument('-S', '--summary', required=False)
+parser.add_argument('-z', '--compress', action='store_true', required=False)
+parser.add_argument('-D', '--dedupe', action='store_true', required=False)
 
 
 class BillingType:
@@ -65,19 +84,264 @@ class Result(dict):
         return bool(self.result)
 
 
-def get_manifest(cdn, app_id, depot_id, manifest_gid, remove_old=False, save_path=None, retry_num=10):
+class AppConfig:
+
+    def __init__(self, app_path):
+        self.path = Path(app_path) / 'config.vdf'
+        self.lock = Lock()
+        self.depots = None
+        self.changed = False
+
+    def load(self):
+        self.depots = {}
+        if self.path.is_file():
+            with self.path.open() as f:
+                self.depots.update(vdf.load(f).get('depots', {}))
+
+    def add(self, depot_id, depot_key):
+        with self.lock:
+            if self.depots is None:
+                self.load()
+            value = {'DecryptionKey': depot_key.hex()}
+            if self.depots.get(str(depot_id)) != value:
+                self.depots[str(depot_id)] = value
+                self.changed = True
+
+    def dump(self):
+        with self.lock:
+            if not self.changed:
+                return False
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with tmp_path.open('w') as f:
+                vdf.dump({'depots': dict(sorted(self.depots.items()))}, f, pretty=True)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+            return True
+
+
+def load_manifest_alias(data):
+    return dict(i.split() for i in data.split('\n') if i)
+
+
+def dump_manifest_alias(alias_dict):
+    return ''.join(f'{name} {alias_dict[name]}\n' for name in sorted(alias_dict))
+
+
+class ManifestAlias:
+
+    def __init__(self, app_path):
+        self.path = Path(app_path) / 'alias.txt'
+        self.lock = Lock()
+        self.alias_dict = None
+        self.changed = False
+
+    def load(self):
+        self.alias_dict = {}
+        if self.path.is_file():
+            self.alias_dict.update(load_manifest_alias(self.path.read_text()))
+
+    def get(self, depot_id, manifest_gid):
+        with self.lock:
+            if self.alias_dict is None:
+                self.load()
+            if target := self.alias_dict.get(f'{depot_id}_{manifest_gid}'):
+                return target.split('_', 1)[1]
+
+    def add(self, depot_id, manifest_gid, same_manifest_gid=None):
+        name = f'{depot_id}_{manifest_gid}'
+        with self.lock:
+            if self.alias_dict is None:
+                self.load()
+            # Only the current gid of a depot is aliased, a newer manifest drops the older aliases of the depot
+            for i in [i for i in self.alias_dict if i.split('_', 1)[0] == str(depot_id) and i != name]:
+                self.alias_dict.pop(i)
+                self.changed = True
+            if same_manifest_gid and self.alias_dict.get(name) != f'{depot_id}_{same_manifest_gid}':
+                self.alias_dict[name] = f'{depot_id}_{same_manifest_gid}'
+                self.changed = True
+
+    def dump(self):
+        with self.lock:
+            if not self.changed:
+                return False
+            if self.alias_dict:
+                tmp_path = self.path.with_name(self.path.name + '.tmp')
+                tmp_path.write_text(dump_manifest_alias(self.alias_dict))
+                os.replace(tmp_path, self.path)
+            else:
+                self.path.unlink(missing_ok=True)
+            self.changed = False
+            return True
+
+
+class DepotKeyStore:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS depot_key (depot_id INTEGER PRIMARY KEY, depot_key TEXT NOT NULL)')
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM depot_key').fetchone()[0]
+
+    def get(self, depot_id):
+        with self.lock:
+            row = self.conn.execute('SELECT depot_key FROM depot_key WHERE depot_id = ?', (int(depot_id),)).fetchone()
+        if row:
+            return bytes.fromhex(row[0])
+
+    def set(self, depot_id, depot_key):
+        self.update([(depot_id, depot_key)])
+
+    def update(self, depot_key_list):
+        depot_key_list = [(int(depot_id), depot_key.hex() if isinstance(depot_key, bytes) else depot_key)
+                          for depot_id, depot_key in depot_key_list]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO depot_key (depot_id, depot_key) VALUES (?, ?)',
+                                  depot_key_list)
+        return len(depot_key_list)
+
+    def import_config(self, content):
+        depot_key_list = []
+        config = vdf.loads(content)
+        if 'depots' in config and type(config['depots']) is dict:
+            for depot_id, depot in config['depots'].items():
+                if type(depot) is dict and len(depot.get('DecryptionKey') or '') == 64 and depot_id.isdecimal():
+                    depot_key_list.append((depot_id, depot['DecryptionKey']))
+        return self.update(depot_key_list)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+process_pool = None
+process_pool_lock = Lock()
+
+
+def get_process_pool(process_num=None):
+    global process_pool
+    with process_pool_lock:
+        if not process_pool:
+            process_pool = ProcessPoolExecutor(process_num, mp_context=multiprocessing.get_context('spawn'))
+    return process_pool
+
+
+def decompress_manifest(data):
+    if data[:2] == b'PK':
+        with ZipFile(BytesIO(data)) as zf:
+            return zf.read(zf.filelist[0])
+    return data
+
+
+def get_payload(data):
+    data = decompress_manifest(data)
+    magic, length = struct.unpack_from('<II', data)
+    if magic != DepotManifest.PROTOBUF_PAYLOAD_MAGIC:
+        raise Exception('Expecting protobuf payload')
+    return memoryview(data)[4:8 + length]
+
+
+def get_crc_clear(data):
+    return crc32(get_payload(data))
+
+
+def get_metadata(data):
+    data = decompress_manifest(data)
+    payload = get_payload(data)
+    offset = len(payload) + 4
+    magic, length = struct.unpack_from('<II', data, offset)
+    if magic != DepotManifest.PROTOBUF_METADATA_MAGIC:
+        raise Exception('Expecting protobuf metadata')
+    metadata = ContentManifestMetadata()
+    metadata.ParseFromString(data[offset + 8:offset + 8 + length])
+    return metadata, crc32(payload)
+
+
+def get_fingerprint(data):
+    return hashlib.sha1(get_payload(data)[4:]).hexdigest()
+
+
+def write_manifest(manifest, f, payload=None):
+    if payload is None:
+        payload = manifest.payload.SerializeToString()
+    header = struct.pack('<II', DepotManifest.PROTOBUF_PAYLOAD_MAGIC, len(payload))
+    manifest.metadata.crc_clear = crc32(payload, crc32(header[4:]))
+    f.write(header)
+    f.write(payload)
+    del payload
+    for magic, part in ((DepotManifest.PROTOBUF_METADATA_MAGIC, manifest.metadata),
+                        (DepotManifest.PROTOBUF_SIGNATURE_MAGIC, manifest.signature)):
+        part = part.SerializeToString()
+        f.write(struct.pack('<II', magic, len(part)))
+        f.write(part)
+    f.write(struct.pack('<I', DepotManifest.PROTOBUF_ENDOFMANIFEST_MAGIC))
+
+
+def dump_manifest(manifest, path, compress=False, payload=None):
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if compress:
+        with ZipFile(tmp_path, 'w', ZIP_DEFLATED) as zf, zf.open('z', 'w') as f:
+            write_manifest(manifest, f, payload)
+    else:
+        with tmp_path.open('wb') as f:
+            write_manifest(manifest, f, payload)
+    os.replace(tmp_path, path)
+
+
+def process_manifest(data, depot_key, manifest_path, compress=False, old_manifest_list=None):
+    manifest = DepotManifest(data)
+    del data
+    manifest.decrypt_filenames(depot_key)
+    manifest.signature = ContentManifestSignature()
+    sha = attrgetter('sha')
+    for mapping in manifest.payload.mappings:
+        mapping.filename = mapping.filename.rstrip('\x00 \n\t')
+        mapping.chunks.sort(key=sha)
+    manifest.payload.mappings.sort(key=lambda x: x.filename.lower())
+    payload = manifest.payload.SerializeToString()
+    if old_manifest_list:
+        fingerprint = hashlib.sha1(payload).hexdigest()
+        for old_manifest_gid, old_manifest_path in old_manifest_list:
+            try:
+                with open(old_manifest_path, 'rb') as f:
+                    if get_fingerprint(f.read()) == fingerprint:
+                        return old_manifest_gid
+            except Exception:
+                pass
+    dump_manifest(manifest, manifest_path, compress, payload)
+
+
+def get_manifest(cdn, app_id, depot_id, manifest_gid, remove_old=False, save_path=None, retry_num=10, app_config=None,
+                 key_store=None, compress=False, manifest_alias=None):
     if not save_path:
         save_path = Path().absolute()
     app_path = save_path / f'depots/{app_id}'
     manifest_path = app_path / f'{depot_id}_{manifest_gid}.manifest'
     if manifest_path.exists():
-        return Result(result=True, code=EResult.OK, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid)
+        return Result(result=True, code=EResult.OK, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid,
+                      exist=True)
+    if manifest_alias is not None and (same_manifest_gid := manifest_alias.get(depot_id, manifest_gid)) \
+            and (app_path / f'{depot_id}_{same_manifest_gid}.manifest').exists():
+        return Result(result=True, code=EResult.OK, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid,
+                      exist=True, same_manifest_gid=same_manifest_gid)
     while True:
         try:
             manifest_code = cdn.get_manifest_request_code(app_id, depot_id, manifest_gid)
-            manifest = cdn.get_manifest(app_id, depot_id, manifest_gid, decrypt=False,
-                                        manifest_request_code=manifest_code)
-            depot_key = cdn.get_depot_key(manifest.app_id, manifest.depot_id)
+            if manifest_code:
+                resp = cdn.cdn_cmd('depot', f'{depot_id}/manifest/{manifest_gid}/5/{manifest_code}')
+            else:
+                resp = cdn.cdn_cmd('depot', f'{depot_id}/manifest/{manifest_gid}/5')
+            depot_key = key_store.get(depot_id) if key_store is not None else None
+            if not depot_key:
+                depot_key = cdn.get_depot_key(app_id, depot_id)
+                if key_store is not None:
+                    key_store.set(depot_id, depot_key)
             break
         except KeyboardInterrupt:
             exit(-1)
@@ -94,37 +358,125 @@ def get_manifest(cdn, app_id, depot_id, manifest_gid, remove_old=False, save_pat
             return Result(result=False, code=EResult.Fail, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid)
     log.info(
         f'{"":<10}app_id: {app_id:<8}{"":<10}depot_id: {depot_id:<8}{"":<10}manifest_gid: {manifest_gid:20}{"":<10}DecryptionKey: {depot_key.hex()}')
-    manifest.decrypt_filenames(depot_key)
-    manifest.signature = ContentManifestSignature()
-    for mapping in manifest.payload.mappings:
-        mapping.filename = mapping.filename.rstrip('\x00 \n\t')
-        mapping.chunks.sort(key=lambda x: x.sha)
-    manifest.payload.mappings.sort(key=lambda x: x.filename.lower())
     if not os.path.exists(app_path):
         os.makedirs(app_path)
-    if os.path.isfile(app_path / 'config.vdf'):
-        with open(app_path / 'config.vdf') as f:
-            d = vdf.load(f)
-    else:
-        d = vdf.VDFDict({'depots': {}})
-    d['depots'][depot_id] = {'DecryptionKey': depot_key.hex()}
-    d = {'depots': dict(sorted(d['depots'].items()))}
+    old_manifest_list = []
+    for file in app_path.iterdir():
+        if file.suffix == '.manifest':
+            depot_id_, manifest_gid_ = file.stem.split('_')
+            if depot_id_ == str(depot_id) and manifest_gid_ != str(manifest_gid):
+                old_manifest_list.append((manifest_gid_, file))
+    # Decrypting, sorting and writing run in a worker process so the hub keeps serving other greenlets
+    # Content-identical manifests are only skipped when the caller records them as aliases
+    future = get_process_pool().submit(process_manifest, resp.content, depot_key, manifest_path, compress,
+                                       old_manifest_list if manifest_alias is not None else None)
+    del resp
+    try:
+        same_manifest_gid = gevent.get_hub().threadpool.apply(future.result)
+    except KeyboardInterrupt:
+        exit(-1)
+    except:
+        log.error(traceback.format_exc())
+        return Result(result=False, code=EResult.Fail, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid)
+    if same_manifest_gid:
+        log.info(f'Manifest {depot_id}_{manifest_gid} has the same content as {depot_id}_{same_manifest_gid}')
     delete_list = []
-    if remove_old:
-        for file in app_path.iterdir():
-            if file.suffix == '.manifest':
-                depot_id_, manifest_gid_ = file.stem.split('_')
-                if depot_id_ == str(depot_id) and manifest_gid_ != str(manifest_gid):
-                    file.unlink(missing_ok=True)
-                    delete_list.append(file.name)
-    buffer = manifest.payload.SerializeToString()
-    manifest.metadata.crc_clear = crc32(struct.pack('<I', len(buffer)) + buffer)
-    with open(manifest_path, 'wb') as f:
-        f.write(manifest.serialize(compress=False))
-    with open(app_path / 'config.vdf', 'w') as f:
-        vdf.dump(d, f, pretty=True)
+    if remove_old and not same_manifest_gid:
+        for manifest_gid_, file in old_manifest_list:
+            file.unlink(missing_ok=True)
+            delete_list.append(file.name)
+    if manifest_alias is not None:
+        manifest_alias.add(depot_id, manifest_gid, same_manifest_gid)
+    if app_config:
+        app_config.add(depot_id, depot_key)
+    else:
+        app_config = AppConfig(app_path)
+        app_config.add(depot_id, depot_key)
+        app_config.dump()
     return Result(result=True, code=EResult.OK, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid,
-                  delete_list=delete_list)
+                  delete_list=delete_list, same_manifest_gid=same_manifest_gid)
+
+
+class CMServerRank:
+    bad_timestamp = 3600
+    default_latency = 5
+
+    def __init__(self):
+        self.lock = Lock()
+        self.path = None
+        self.servers = {}
+
+    def load(self, path):
+        with self.lock:
+            if self.path:
+                return
+            self.path = Path(path)
+            if self.path.is_file():
+                try:
+                    with self.path.open() as f:
+                        self.servers.update(json.load(f))
+                except ValueError:
+                    pass
+
+    def dump(self):
+        if self.path:
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with tmp_path.open('w') as f:
+                json.dump(self.servers, f)
+            os.replace(tmp_path, self.path)
+
+    def key(self, server_addr):
+        info = self.servers.get('%s:%s' % tuple(server_addr))
+        if not info:
+            return 1, self.default_latency
+        if time.time() - info.get('bad_timestamp', 0) < self.bad_timestamp:
+            return 2, info.get('fail', 0)
+        return 0, info.get('latency', self.default_latency)
+
+    def sort(self, server_list):
+        with self.lock:
+            return sorted(server_list, key=self.key)
+
+    def mark_good(self, server_addr, latency):
+        with self.lock:
+            info = self.servers.setdefault('%s:%s' % tuple(server_addr), {})
+            info['latency'] = round(latency * 0.3 + info.get('latency', latency) * 0.7, 3)
+            info['fail'] = 0
+            info.pop('bad_timestamp', None)
+            self.dump()
+
+    def mark_bad(self, server_addr):
+        with self.lock:
+            info = self.servers.setdefault('%s:%s' % tuple(server_addr), {})
+            info['fail'] = info.get('fail', 0) + 1
+            info['bad_timestamp'] = int(time.time())
+            self.dump()
+
+
+class RankedCMServerList(CMServerList):
+
+    def __init__(self, rank):
+        CMServerList.__init__(self)
+        self.rank = rank
+        self.attempt = None
+
+    def __iter__(self):
+        def cm_server_iter():
+            good_servers = [server_addr for server_addr, meta in self.list.items()
+                            if meta['quality'] == CMServerList.Good]
+            if not good_servers:
+                if self.list:
+                    self.reset_all()
+                else:
+                    self._LOG.error("Server list is empty.")
+                return
+            for server_addr in self.rank.sort(good_servers):
+                self.attempt = (server_addr, time.time())
+                yield server_addr
+                self.rank.mark_bad(server_addr)
+                self.attempt = None
+
+        return cm_server_iter()
 
 
 class MySteamClient(SteamClient):
@@ -132,6 +484,8 @@ class MySteamClient(SteamClient):
     _LOG = logging.getLogger('MySteamClient')
     sentry_path = None
     login_key_path = None
+    cm_rank = CMServerRank()
+    connect_time = 0
 
     def __init__(self, credential_location=None, sentry_path=None, retry=1):
         self.retry = retry
@@ -145,6 +499,8 @@ class MySteamClient(SteamClient):
             elif (Path('client') / sentry_path).exists():
                 self.sentry_path = str(Path('client') / sentry_path)
         SteamClient.__init__(self)
+        self.cm_rank.load(Path(self.credential_location) / 'cm_rank.json')
+        self.cm_servers = RankedCMServerList(self.cm_rank)
 
     def _handle_update_machine_auth(self, message):
         SteamClient._handle_update_machine_auth(self, message)
@@ -182,7 +538,15 @@ class MySteamClient(SteamClient):
         """Attempt to establish connection, see :meth:`.CMClient.connect`"""
         self._bootstrap_cm_list_from_file()
         kwargs['retry'] = self.retry
-        return CMClient.connect(self, *args, **kwargs)
+        start = time.time()
+        self.cm_servers.attempt = None
+        result = CMClient.connect(self, *args, **kwargs)
+        self.connect_time += time.time() - start
+        if result and self.cm_servers.attempt:
+            server_addr, attempt_start = self.cm_servers.attempt
+            self.cm_rank.mark_good(server_addr, time.time() - attempt_start)
+            self._LOG.info(f'Connected to {server_addr[0]}:{server_addr[1]} in {time.time() - start:.2f}s')
+        return result
 
 
 class MyCDNClient(CDNClient):
@@ -214,73 +578,185 @@ class MyCDNClient(CDNClient):
 log = logging.getLogger('DepotManifestGen')
 
 
-def main(args=None):
-    if args:
-        args = parser.parse_args(args)
-    else:
-        args = parser.parse_args()
-    if args.level:
-        level = logging.getLevelName(args.level.upper())
-    else:
-        level = logging.INFO
-    logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s', level=level)
-    steam = MySteamClient(args.credential_location, args.sentry_path, args.retry)
-    steam.username = args.username
-    if args.login_key:
+def dump_app_config(job_list, app_config, manifest_alias=None):
+    gevent.joinall(job_list)
+    app_config.dump()
+    if manifest_alias is not None:
+        manifest_alias.dump()
+
+
+def login(args, username, password, sentry_path=None):
+    steam = MySteamClient(args.credential_location, sentry_path, args.retry)
+    steam.username = username
+    if args.login_key and not args.batch:
         steam.login_key = args.login_key
     result = steam.relogin()
     if result != EResult.OK:
-        if args.cli:
-            result = steam.cli_login(args.username, args.password)
+        if args.batch:
+            result = steam.login(username, password, steam.login_key)
+        elif args.cli:
+            result = steam.cli_login(username, password)
         else:
-            result = steam.login(args.username, args.password, args.login_key, args.auth_code, args.two_factor_code,
+            result = steam.login(username, password, args.login_key, args.auth_code, args.two_factor_code,
                                  int(args.login_id) if args.login_id else None)
-    if result != EResult.OK:
-        log.error(f'Login failure reason: {result.__repr__()}')
-        exit(result)
+    return steam, result
+
+
+def get_paid_app_id_list(cdn):
     app_id_list = []
-    app_id_list_all = set()
-    depot_id_list = []
-    packages_info = []
-    cdn = MyCDNClient(steam)
     if cdn.packages_info:
-        for package_id, info in steam.get_product_info(packages=cdn.packages_info)['packages'].items():
+        for package_id, info in cdn.packages_info.items():
             if 'appids' in info and 'depotids' in info and info['billingtype'] in BillingType.PaidList:
-                app_id_list_all.update(list(info['appids'].values()))
                 app_id_list.extend(list(info['appids'].values()))
-                depot_id_list.extend(list(info['depotids'].values()))
-                packages_info.append((list(info['appids'].values()), list(info['depotids'].values())))
-    if args.app_id:
-        app_id_list = {int(app_id) for app_id in args.app_id.split(',')}
-        app_id_list_all.update(app_id_list)
-    fresh_resp = steam.get_product_info(app_id_list)
+    return app_id_list
+
+
+def run_account(args, cdn, app_id_list, key_store=None, app_config_dict=None, manifest_set=None,
+                manifest_alias_dict=None):
     app_types = ['game', 'dlc', 'application', 'music']
-    if args.list_apps:
-        for app_id in app_id_list_all:
-            app = fresh_resp['apps'][app_id]
-            if 'common' in app and app['common']['type'].lower() in app_types:
-                log.info("%s | %s | %s", app_id, app['common']['type'].upper(), app['common']['name'])
-        exit()
+    if app_config_dict is None:
+        app_config_dict = {}
+    if manifest_alias_dict is None:
+        manifest_alias_dict = {}
+    if manifest_set is None:
+        manifest_set = set()
+    summary = {'fetched': [], 'skipped': [], 'failed': []}
     result_list = []
+    manifest_job_list = []
+    licensed_id_set = {*cdn.licensed_depot_ids, *cdn.licensed_app_ids}
+    fresh_resp = cdn.steam.get_product_info(app_id_list)
     for app_id in app_id_list:
         app = fresh_resp['apps'][app_id]
         if 'common' in app and app['common']['type'].lower() in app_types:
             if 'depots' not in fresh_resp['apps'][app_id]:
                 continue
+            if app_id not in app_config_dict:
+                app_config_dict[app_id] = AppConfig(Path().absolute() / f'depots/{app_id}')
+            app_config = app_config_dict[app_id]
+            manifest_alias = None
+            if args.dedupe:
+                if app_id not in manifest_alias_dict:
+                    manifest_alias_dict[app_id] = ManifestAlias(Path().absolute() / f'depots/{app_id}')
+                manifest_alias = manifest_alias_dict[app_id]
+            job_list = []
             for depot_id, depot in fresh_resp['apps'][app_id]['depots'].items():
-                if 'manifests' in depot and 'public' in depot['manifests'] and int(
-                        depot_id) in {*cdn.licensed_depot_ids, *cdn.licensed_app_ids}:
+                if 'manifests' in depot and 'public' in depot['manifests'] and int(depot_id) in licensed_id_set:
                     manifest_gid = depot['manifests']['public']
                     if isinstance(manifest_gid, dict):
                         manifest_gid = manifest_gid.get('gid')
                     if not isinstance(manifest_gid, str):
                         continue
-                    result_list.append(gevent.spawn(get_manifest, cdn, app_id, depot_id, manifest_gid, args.remove_old))
+                    if (depot_id, manifest_gid) in manifest_set:
+                        summary['skipped'].append(f'{depot_id}_{manifest_gid}')
+                        continue
+                    manifest_set.add((depot_id, manifest_gid))
+                    job_list.append(gevent.spawn(get_manifest, cdn, app_id, depot_id, manifest_gid, args.remove_old,
+                                                 app_config=app_config, key_store=key_store,
+                                                 compress=args.compress, manifest_alias=manifest_alias))
                     gevent.idle()
+            if job_list:
+                manifest_job_list.extend(job_list)
+                result_list.extend(job_list)
+                result_list.append(gevent.spawn(dump_app_config, job_list, app_config, manifest_alias))
+    del fresh_resp
+    gevent.joinall(result_list)
+    for job in manifest_job_list:
+        if isinstance(job.value, Result):
+            name = f'{job.value["depot_id"]}_{job.value["manifest_gid"]}'
+            if not job.value:
+                summary['failed'].append(name)
+                manifest_set.discard((job.value['depot_id'], job.value['manifest_gid']))
+            elif job.value.get('exist') or job.value.get('same_manifest_gid'):
+                summary['skipped'].append(name)
+            else:
+                summary['fetched'].append(name)
+        elif job.exception:
+            summary['failed'].append(repr(job.exception))
+    return summary
+
+
+def run_batch(args, key_store=None):
+    with open(args.batch) as f:
+        account_info = json.load(f)
+    app_config_dict = {}
+    manifest_alias_dict = {}
+    manifest_set = set()
+    summary_dict = {}
+    pool = Pool(args.concurrency)
+
+    def task(username, password, sentry_name):
+        summary = summary_dict[username] = {'result': None, 'connect_time': 0}
+        sentry_path = str(Path(args.credential_location or MySteamClient.credential_location) / sentry_name) \
+            if sentry_name else None
+        steam, result = login(args, username, password, sentry_path)
+        summary['result'] = int(result)
+        summary['connect_time'] = round(steam.connect_time, 3)
+        if result != EResult.OK:
+            log.error(f'User {username}: Login failure reason: {result.__repr__()}')
+            return
+        try:
+            cdn = MyCDNClient(steam)
+            summary.update(run_account(args, cdn, get_paid_app_id_list(cdn), key_store, app_config_dict,
+                                       manifest_set, manifest_alias_dict))
+        finally:
+            steam.logout()
+        log.info(f'User {username}: {len(summary["fetched"])} fetched, {len(summary["skipped"])} skipped, '
+                 f'{len(summary["failed"])} failed, connection setup took {summary["connect_time"]}s')
+
+    for username, (password, sentry_name) in account_info.items():
+        pool.spawn(task, username, password, sentry_name)
+    try:
+        pool.join()
+    except KeyboardInterrupt:
+        exit(-1)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary_dict, f, indent=2)
+    return summary_dict
+
+
+def main(args=None):
+    if args:
+        args = parser.parse_args(args)
+    else:
+        args = parser.parse_args()
+    if args.level:
+        level = logging.getLevelName(args.level.upper())
+    else:
+        level = logging.INFO
+    logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s', level=level)
+    if not args.username and not args.batch:
+        parser.error('one of the arguments -u/--username -b/--batch is required')
+    get_process_pool(args.process_num)
+    key_store = DepotKeyStore(args.key_store) if args.key_store else None
+    if args.batch:
+        run_batch(args, key_store)
+        return
+    steam, result = login(args, args.username, args.password, args.sentry_path)
+    if result != EResult.OK:
+        log.error(f'Login failure reason: {result.__repr__()}')
+        exit(result)
+    cdn = MyCDNClient(steam)
+    app_id_list = get_paid_app_id_list(cdn)
+    app_id_list_all = set(app_id_list)
+    if args.app_id:
+        app_id_list = [int(app_id) for app_id in set(args.app_id.split(','))]
+        app_id_list_all.update(app_id_list)
+    if args.list_apps:
+        fresh_resp = steam.get_product_info(list(app_id_list_all))
+        for app_id in app_id_list_all:
+            app = fresh_resp['apps'][app_id]
+            if 'common' in app and app['common']['type'].lower() in ['game', 'dlc', 'application', 'music']:
+                log.info("%s | %s | %s", app_id, app['common']['type'].upper(), app['common']['name'])
+        exit()
+    summary = {'result': int(result), 'connect_time': round(steam.connect_time, 3)}
     try:
-        gevent.joinall(result_list)
+        summary.update(run_account(args, cdn, app_id_list, key_store))
     except KeyboardInterrupt:
         exit(-1)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({args.username: summary}, f, indent=2)
 
 
 if __name__ == '__main__':
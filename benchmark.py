@@ -0,0 +1,60 @@
+import git
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from steam.core.manifest import DepotManifest
+from DepotManifestGen.main import decompress_manifest, dump_manifest
+
+
+def get_repo_size(repo):
+    info = dict(i.split(': ') for i in repo.git.count_objects('-v').split('\n'))
+    return (int(info['size']) + int(info['size-pack'])) * 1024
+
+
+def build_repo(path, manifest_list, compress=False):
+    repo = git.Repo.init(path)
+    repo.git.config('user.name', 'benchmark')
+    repo.git.config('user.email', 'benchmark@localhost')
+    for manifest_path in manifest_list:
+        app_path = Path(path) / manifest_path.parent.name
+        app_path.mkdir(exist_ok=True)
+        with manifest_path.open('rb') as f:
+            manifest = DepotManifest(decompress_manifest(f.read()))
+        dump_manifest(manifest, app_path / manifest_path.name, compress)
+        repo.git.add(app_path / manifest_path.name)
+        repo.git.commit('-m', f'Update depot: {manifest_path.stem}')
+    repo.git.gc('--quiet')
+    return repo
+
+
+def push_repo(repo, path):
+    git.Repo.init(path, bare=True)
+    start = time.time()
+    repo.git.push(str(path), '--all', '--quiet')
+    return time.time() - start
+
+
+def benchmark(path):
+    manifest_list = sorted(Path(path).glob('**/*.manifest'))
+    if not manifest_list:
+        print(f'No manifest found in {path}!')
+        return
+    print(f'{len(manifest_list)} manifests')
+    print(f'{"format":<12}{"repo size":>16}{"push time":>16}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for compress in (False, True):
+            name = 'compressed' if compress else 'raw'
+            repo = build_repo(Path(tmp) / name, manifest_list, compress)
+            size = get_repo_size(repo)
+            push_time = push_repo(repo, Path(tmp) / f'{name}.git')
+            print(f'{name:<12}{size / 1024 / 1024:>14.2f}MB{push_time:>15.2f}s')
+            repo.close()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--path', default='data/depots')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    benchmark(args.path)
@@ -0,0 +1,63 @@
+import subprocess
+from threading import Lock
+from git.objects.fun import tree_entries_from_data
+
+
+class CatFile:
+    chunk_size = 256
+
+    def __init__(self, path='.'):
+        self.path = path
+        self.lock = Lock()
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=path, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read_object(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise Exception('git cat-file exited unexpectedly')
+        header = line.decode().split()
+        if len(header) != 3:
+            return
+        sha, type_, size = header
+        data = self.proc.stdout.read(int(size))
+        self.proc.stdout.read(1)
+        return sha, type_, data
+
+    def read(self, obj):
+        with self.lock:
+            self.proc.stdin.write(f'{obj}\n'.encode())
+            self.proc.stdin.flush()
+            return self.read_object()
+
+    def iter_read(self, obj_list):
+        obj_list = list(obj_list)
+        for i in range(0, len(obj_list), self.chunk_size):
+            chunk = obj_list[i:i + self.chunk_size]
+            with self.lock:
+                self.proc.stdin.write(''.join(f'{obj}\n' for obj in chunk).encode())
+                self.proc.stdin.flush()
+                result = [(obj, self.read_object()) for obj in chunk]
+            yield from result
+
+    def tree(self, rev):
+        if result := self.read(f'{rev}^{{tree}}'):
+            return tree_entries_from_data(result[2])
+        return []
+
+    def iter_tree(self, rev_list):
+        rev_list = list(rev_list)
+        for rev, (_, result) in zip(rev_list, self.iter_read(f'{rev}^{{tree}}' for rev in rev_list)):
+            yield rev, tree_entries_from_data(result[2]) if result else []
+
+    def close(self):
+        with self.lock:
+            if self.proc.poll() is None:
+                self.proc.stdin.close()
+                self.proc.wait()
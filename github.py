@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import requests
+from pathlib import Path
+from threading import Lock
+
+
+class GitHubCache:
+
+    def __init__(self, path, email_path=None):
+        self.path = Path(path)
+        self.email_path = Path(email_path) if email_path else self.path.with_name('github_email.json')
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS response (url TEXT PRIMARY KEY, etag TEXT NOT NULL, '
+                              'body TEXT NOT NULL)')
+        # The small login to email map is kept apart from the response cache so it can be committed
+        self.email_dict = {}
+        if self.email_path.is_file():
+            with self.email_path.open() as f:
+                self.email_dict.update(json.load(f))
+
+    def get_response(self, url):
+        with self.lock:
+            return self.conn.execute('SELECT etag, body FROM response WHERE url = ?', (url,)).fetchone()
+
+    def set_response(self, url, etag, body):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO response (url, etag, body) VALUES (?, ?, ?)', (url, etag, body))
+
+    def get_email(self, login):
+        with self.lock:
+            return self.email_dict.get(login)
+
+    def set_email(self, login, email):
+        with self.lock:
+            if self.email_dict.get(login) == email:
+                return
+            self.email_dict[login] = email
+            tmp_path = self.email_path.with_name(self.email_path.name + '.tmp')
+            with tmp_path.open('w') as f:
+                json.dump(dict(sorted(self.email_dict.items())), f, indent=2)
+            os.replace(tmp_path, self.email_path)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+PR_QUERY = '''
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        headRefName
+        headRepositoryOwner { login }
+        author { login ... on User { databaseId } ... on Bot { databaseId } }
+      }
+    }
+  }
+}
+'''
+
+
+class GitHub:
+    log = logging.getLogger('GitHub')
+    api_url = 'https://api.github.com'
+    retry_num = 5
+    write_interval = 1
+
+    def __init__(self, token=None, cache_path=None, api_url=None, graphql=False):
+        self.api_url = (api_url or self.api_url).rstrip('/')
+        self.graphql = graphql
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/vnd.github+json', 'X-GitHub-Api-Version': '2022-11-28'})
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+        self.cache = GitHubCache(cache_path) if cache_path else None
+        self.lock = Lock()
+        self.remaining = None
+        self.reset_time = 0
+        self.wait_until = 0
+        self.last_write_time = 0
+
+    def wait(self, write=False):
+        with self.lock:
+            now = time.time()
+            wait_until = self.wait_until
+            if self.remaining is not None and self.remaining <= 0:
+                wait_until = max(wait_until, self.reset_time + 1)
+            if write:
+                wait_until = max(wait_until, self.last_write_time + self.write_interval)
+                self.last_write_time = max(now, wait_until)
+            if self.remaining is not None:
+                self.remaining -= 1
+        if (count := wait_until - now) > 0:
+            self.log.info(f'Wait {count:.0f} second!')
+            time.sleep(count)
+
+    def update_limit(self, r):
+        with self.lock:
+            if 'X-RateLimit-Remaining' in r.headers:
+                self.remaining = int(r.headers['X-RateLimit-Remaining'])
+                self.reset_time = int(r.headers.get('X-RateLimit-Reset', 0))
+            if r.status_code in (403, 429):
+                if 'Retry-After' in r.headers:
+                    self.wait_until = time.time() + int(r.headers['Retry-After'])
+                elif self.remaining == 0:
+                    self.wait_until = self.reset_time + 1
+                elif 'secondary rate limit' in r.text.lower():
+                    self.wait_until = time.time() + 60
+                else:
+                    return False
+                return True
+        return False
+
+    def request(self, method, path, **kwargs):
+        url = path if path.startswith(self.api_url) else f'{self.api_url}/{path.lstrip("/")}'
+        write = method != 'GET' and not url.endswith('/graphql')
+        for _ in range(self.retry_num):
+            self.wait(write)
+            r = self.session.request(method, url, **kwargs)
+            if not self.update_limit(r):
+                return r
+            self.log.info(f'Rate limited: {method} {url}')
+        return r
+
+    def get(self, path):
+        url = f'{self.api_url}/{path.lstrip("/")}'
+        cached = self.cache.get_response(url) if self.cache else None
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        r = self.request('GET', url, headers=headers)
+        if r.status_code == 304 and cached:
+            self.log.debug(f'Not modified: {url}')
+            return json.loads(cached[1])
+        if self.cache and r.status_code == 200 and (etag := r.headers.get('ETag')):
+            self.cache.set_response(url, etag, r.text)
+        return r.json()
+
+    def get_all_pages(self, path):
+        result = []
+        page = 1
+        while True:
+            data = self.get(f'{path}{"&" if "?" in path else "?"}per_page=100&page={page}')
+            if not data or type(data) is not list:
+                break
+            result.extend(data)
+            page += 1
+        return result
+
+    def query(self, query, **variables):
+        r = self.request('POST', 'graphql', json={'query': query, 'variables': variables})
+        result = r.json()
+        if result.get('errors') or not result.get('data'):
+            raise Exception(f'GraphQL query failed: {result.get("errors") or r.text}')
+        return result['data']
+
+    def get_all_pr_graphql(self, repo_url):
+        owner, name = repo_url.split('/')
+        pr_list = []
+        cursor = None
+        while True:
+            pull_requests = self.query(PR_QUERY, owner=owner, name=name, cursor=cursor)['repository']['pullRequests']
+            for i in pull_requests['nodes']:
+                head_owner = (i.get('headRepositoryOwner') or {}).get('login')
+                author = i.get('author') or {}
+                pr_list.append({'number': i['number'],
+                                'head': {'ref': i['headRefName'], 'label': f'{head_owner}:{i["headRefName"]}'},
+                                'user': {'login': author.get('login'), 'id': author.get('databaseId')}})
+            if not pull_requests['pageInfo']['hasNextPage']:
+                break
+            cursor = pull_requests['pageInfo']['endCursor']
+        return pr_list
+
+    def get_all_pr(self, repo_url):
+        if self.graphql:
+            return self.get_all_pr_graphql(repo_url)
+        return self.get_all_pages(f'repos/{repo_url}/pulls')
+
+    def create_pr(self, repo_url, title, head, base, body=None):
+        return self.request('POST', f'repos/{repo_url}/pulls',
+                            json={'title': title, 'head': head, 'base': base, 'body': body})
+
+    def close_pr(self, repo_url, num):
+        return self.request('PATCH', f'repos/{repo_url}/pulls/{num}', json={'state': 'closed'})
+
+    def delete_branch(self, repo_url, branch):
+        return self.request('DELETE', f'repos/{repo_url}/git/refs/heads/{branch}')
+
+    def get_user_email(self, author_name, user_id=None):
+        if self.cache and (email := self.cache.get_email(author_name)):
+            return email
+        email_set = set()
+        events = self.get(f'users/{author_name}/events/public')
+        for i in events if type(events) is list else []:
+            if not (payload := i.get('payload')):
+                continue
+            if not (commits := payload.get('commits')):
+                continue
+            for commit in commits:
+                if not (author := commit.get('author')):
+                    continue
+                if not (name := author.get('name')):
+                    continue
+                if name != author_name:
+                    continue
+                if not (email := author.get('email')):
+                    continue
+                email_set.add(email)
+        email = None
+        for i in email_set:
+            if not i.endswith('@users.noreply.github.com'):
+                email = i
+                break
+        else:
+            if email_set:
+                email = email_set.pop()
+            elif user_id:
+                email = f'{user_id}+{author_name}@users.noreply.github.com'
+        if email and self.cache:
+            self.cache.set_email(author_name, email)
+        return email
@@ -1,6 +1,5 @@
 import os
 import git
-import sys
 import json
 import time
 import base64
@@ -13,15 +12,17 @@ import functools
 import traceback
 import subprocess
 from pathlib import Path
+from catfile import CatFile
 from steam.enums import EResult
-from push import push, push_data
+from manifestindex import ManifestIndex
 from multiprocessing.pool import ThreadPool
 from multiprocessing.dummy import Pool, Lock
+from push import push, push_data, PushJournal
 from steam.guard import generate_twofactor_code
-from DepotManifestGen.main import MySteamClient, MyCDNClient, get_manifest, BillingType, Result
+from DepotManifestGen.main import MySteamClient, MyCDNClient, get_manifest, BillingType, Result, AppConfig, \
+    DepotKeyStore, ManifestAlias
 
 lock = Lock()
-sys.setrecursionlimit(100000)
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--credential-location', default=None)
 parser.add_argument('-l', '--level', default='INFO')
@@ -35,6 +36,10 @@ parser.add_argument('-P', '--no-push', action='store_true', default=False)
 parser.add_argument('-u', '--update', action='store_true', default=False)
 parser.add_argument('-a', '--app-id', dest='app_id_list', action='extend', nargs='*')
 parser.add_argument('-U', '--users', dest='user_list', action='extend', nargs='*')
+parser.add_argument('-z', '--compress', action='store_true', default=False)
+parser.add_argument('-b', '--partial-clone', action='store_true', default=False)
+parser.add_argument('-I', '--manifest-index', action='store_true', default=False)
+parser.add_argument('-T', '--no-tags', action='store_true', default=False)
 
 
 class MyJson(dict):
@@ -77,18 +82,24 @@ class ManifestAutoUpdate:
     app_info_path = ROOT / Path('appinfo.json')
     user_info_path = ROOT / Path('userinfo.json')
     two_factor_path = ROOT / Path('2fa.json')
+    depot_key_path = ROOT / Path('depotkeys.db')
     key_path = ROOT / 'KEY'
     git_crypt_path = ROOT / ('git-crypt' + ('.exe' if platform.system().lower() == 'windows' else ''))
     repo = git.Repo()
+    journal = PushJournal(ROOT)
     app_lock = {}
     pool_num = 8
     retry_num = 3
     remote_head = {}
     update_wait_time = 86400
+    app_info_chunk_size = 300
+    fetch_chunk_size = 200
+    fetched_app_set = set()
     tags = set()
 
     def __init__(self, credential_location=None, level=None, pool_num=None, retry_num=None, update_wait_time=None,
-                 key=None, init_only=False, cli=False, app_id_list=None, user_list=None):
+                 key=None, init_only=False, cli=False, app_id_list=None, user_list=None, compress=False,
+                 partial_clone=False, manifest_index=False, no_tags=False):
         if level:
             level = logging.getLevelName(level.upper())
         else:
@@ -98,6 +109,9 @@ class ManifestAutoUpdate:
         logging.getLogger('MySteamClient').setLevel(logging.WARNING)
         self.init_only = init_only
         self.cli = cli
+        self.compress = compress
+        self.partial_clone = partial_clone
+        self.create_tags = not no_tags
         self.pool_num = pool_num or self.pool_num
         self.retry_num = retry_num or self.retry_num
         self.update_wait_time = update_wait_time or self.update_wait_time
@@ -108,13 +122,23 @@ class ManifestAutoUpdate:
         if not self.check_app_repo_local('app'):
             if self.check_app_repo_remote('app'):
                 self.log.info('Pulling remote app branch!')
-                self.repo.git.fetch('origin', 'app:app')
+                self.fetch('origin', 'app:app')
             else:
                 try:
                     self.log.info('Getting the full branch!')
-                    self.repo.git.fetch('--unshallow')
+                    if self.partial_clone:
+                        # Finding the root commit only needs the commits, not their trees
+                        self.repo.git.fetch('--filter=tree:0', '--unshallow')
+                    else:
+                        self.repo.git.fetch('--unshallow')
                 except git.exc.GitCommandError as e:
                     self.log.debug(f'Getting the full branch failed: {e}')
+                if self.partial_clone:
+                    # The filter is saved as the remote default, later plain fetches must not turn treeless
+                    try:
+                        self.repo.git.config('--unset', 'remote.origin.partialclonefilter')
+                    except git.exc.GitCommandError:
+                        pass
                 self.app_sha = self.repo.git.rev_list('--max-parents=0', 'HEAD').strip()
                 self.log.debug(f'app_sha: {self.app_sha}')
                 self.repo.git.branch('app', self.app_sha)
@@ -124,7 +148,7 @@ class ManifestAutoUpdate:
         if not self.check_app_repo_local('data'):
             if self.check_app_repo_remote('data'):
                 self.log.info('Pulling remote data branch!')
-                self.repo.git.fetch('origin', 'data:origin_data')
+                self.fetch('origin', 'data:origin_data')
                 self.repo.git.worktree('add', '-b', 'data', 'data', 'origin_data')
             else:
                 self.repo.git.worktree('add', '-b', 'data', 'data', 'app')
@@ -160,8 +184,22 @@ class ManifestAutoUpdate:
         self.user_info = MyJson(self.user_info_path)
         self.app_info = MyJson(self.app_info_path)
         self.two_factor = MyJson(self.two_factor_path)
-        self.log.info('Waiting to get remote tags!')
-        self.get_remote_tags()
+        self.key_store = DepotKeyStore(self.depot_key_path)
+        if not len(self.key_store):
+            self.import_depot_key()
+        # Keep the index up to date whenever it exists, pr.py prefers it over tags
+        self.log.info('Waiting to get the manifest index!')
+        self.manifest_index = ManifestIndex(self.repo)
+        if not self.manifest_index.fetch() and not self.manifest_index.read(ManifestIndex.ref)[0]:
+            if manifest_index or no_tags:
+                self.log.warning('Manifest index not found, run manifestindex.py -i in a full clone to create it! '
+                                 'Falling back to tags.')
+            self.manifest_index = None
+            self.create_tags = True
+        self.use_manifest_index = self.manifest_index is not None and (manifest_index or no_tags)
+        if not self.use_manifest_index:
+            self.log.info('Waiting to get remote tags!')
+            self.get_remote_tags()
         self.update_user_list = [*user_list] if user_list else []
         self.update_app_id_list = []
         if app_id_list:
@@ -191,7 +229,23 @@ class ManifestAutoUpdate:
             traceback.print_exc()
             exit()
 
-    def get_manifest_callback(self, username, app_id, depot_id, manifest_gid, args):
+    def import_depot_key(self):
+        count = 0
+        ref_list = self.repo.git.for_each_ref('--format=%(refname)', 'refs/heads', 'refs/remotes').split('\n')
+        ref_list = [ref for ref in ref_list if ref.split('/')[-1].split('_')[-1].isdecimal()]
+        with CatFile(self.repo.working_dir) as cat_file:
+            if self.partial_clone:
+                self.prefetch_blob(cat_file, ref_list, 'config.vdf')
+            for obj, result in cat_file.iter_read(f'{ref}:config.vdf' for ref in ref_list):
+                if not result:
+                    continue
+                try:
+                    count += self.key_store.import_config(result[2].decode())
+                except:
+                    logging.error(traceback.format_exc())
+        self.log.info(f'Imported {count} depot keys!')
+
+    def get_manifest_callback(self, username, app_id, depot_id, manifest_gid, result_list, args):
         result = args.value
         if not result:
             self.log.warning(f'User {username}: get_manifest return {result.code.__repr__()}')
@@ -204,29 +258,73 @@ class ManifestAutoUpdate:
                 self.log.warning('Deleted multiple files?')
             self.set_depot_info(depot_id, manifest_gid)
             app_repo = git.Repo(app_path)
+            if same_manifest_gid := result.get('same_manifest_gid'):
+                manifest_commit = app_repo.git.rev_list('-1', 'HEAD', '--',
+                                                        f'{depot_id}_{same_manifest_gid}.manifest').strip()
+            # Only stage the manifest, save_app_config commits it together with config.vdf
             with lock:
-                if manifest_commit:
-                    app_repo.create_tag(f'{depot_id}_{manifest_gid}', manifest_commit)
-                else:
+                if not manifest_commit:
                     if delete_list:
                         app_repo.git.rm(delete_list)
                     app_repo.git.add(f'{depot_id}_{manifest_gid}.manifest')
-                    app_repo.git.add('config.vdf')
-                    app_repo.index.commit(f'Update depot: {depot_id}_{manifest_gid}')
-                    app_repo.create_tag(f'{depot_id}_{manifest_gid}')
+                # An alias that was already recorded by an earlier run adds nothing to commit
+                result_list.append((depot_id, manifest_gid, manifest_commit,
+                                    None if result.get('exist') else same_manifest_gid))
         except KeyboardInterrupt:
             raise
         except:
             logging.error(traceback.format_exc())
         finally:
             with lock:
+                # The app stays locked until save_app_config has committed and tagged it
                 if int(app_id) in self.app_lock:
-                    self.app_lock[int(app_id)].remove(depot_id)
+                    self.app_lock[int(app_id)].discard(depot_id)
                     if int(app_id) not in self.user_info[username]['app']:
                         self.user_info[username]['app'].append(int(app_id))
-                    if not self.app_lock[int(app_id)]:
-                        self.log.debug(f'Unlock app: {app_id}')
-                        self.app_lock.pop(int(app_id))
+
+    def save_app_config(self, app_id, app_config, manifest_alias, job_list, result_list):
+        gevent.joinall(job_list)
+        try:
+            with lock:
+                app_repo = git.Repo(self.ROOT / f'depots/{app_id}')
+                config_changed = app_config.dump()
+                if config_changed:
+                    app_repo.git.add('config.vdf')
+                # Content-identical manifests are recorded in alias.txt so merge.py and storage.py can resolve them
+                if manifest_alias.dump():
+                    app_repo.git.add('-A', '--', 'alias.txt')
+                tag_list = [f'{depot_id}_{manifest_gid}' for depot_id, manifest_gid, manifest_commit, same_manifest_gid
+                            in result_list if not manifest_commit or same_manifest_gid]
+                commit = None
+                if tag_list or config_changed:
+                    if not tag_list:
+                        message = f'Update config: {app_id}'
+                    elif len(tag_list) == 1:
+                        message = f'Update depot: {tag_list[0]}'
+                    else:
+                        message = f'Update depots: {", ".join(tag_list)}'
+                    commit = app_repo.index.commit(message).hexsha
+                    self.journal.add(f'refs/heads/{app_id}')
+                # Tag only after the manifests and their keys are committed
+                for depot_id, manifest_gid, manifest_commit, _ in result_list:
+                    if self.create_tags:
+                        try:
+                            app_repo.create_tag(f'{depot_id}_{manifest_gid}', manifest_commit or commit)
+                        except git.exc.GitCommandError as e:
+                            self.log.warning(f'Creating tag {depot_id}_{manifest_gid} failed: {e}')
+                        else:
+                            self.journal.add(f'refs/tags/{depot_id}_{manifest_gid}')
+                    if self.manifest_index is not None:
+                        self.manifest_index.add(depot_id, manifest_gid, app_id)
+        except KeyboardInterrupt:
+            raise
+        except:
+            logging.error(traceback.format_exc())
+        finally:
+            with lock:
+                if int(app_id) in self.app_lock and not self.app_lock[int(app_id)]:
+                    self.log.debug(f'Unlock app: {app_id}')
+                    self.app_lock.pop(int(app_id))
 
     def set_depot_info(self, depot_id, manifest_gid):
         with lock:
@@ -236,6 +334,10 @@ class ManifestAutoUpdate:
         with lock:
             self.user_info.dump()
 
+    def save_manifest_index(self):
+        if self.manifest_index is not None and self.manifest_index.commit():
+            self.journal.add(ManifestIndex.ref)
+
     def save(self):
         self.save_depot_info()
         self.save_user_info()
@@ -244,6 +346,24 @@ class ManifestAutoUpdate:
         with lock:
             self.app_info.dump()
 
+    def fetch(self, *args):
+        # Leave the blobs on the remote, checkouts only download the ones of the branch tips they need
+        if self.partial_clone:
+            args = ('--filter=blob:none', *args)
+        return self.repo.git.fetch(*args)
+
+    def prefetch_blob(self, cat_file, ref_list, name):
+        # Download the blobs missing from a partial clone in a few fetches instead of one lazy fetch per blob
+        sha_list = []
+        for obj, entry_list in cat_file.iter_tree(ref_list):
+            sha_list.extend(binsha.hex() for binsha, mode, name_ in entry_list if name_ == name)
+        for i in range(0, len(sha_list), self.fetch_chunk_size):
+            try:
+                self.repo.git.fetch('origin', '--no-tags', '--no-write-fetch-head',
+                                    *sha_list[i:i + self.fetch_chunk_size])
+            except git.exc.GitCommandError as e:
+                self.log.warning(f'Prefetching {name} blobs failed: {e}')
+
     def get_app_worktree(self):
         worktree_dict = {}
         with lock:
@@ -285,11 +405,34 @@ class ManifestAutoUpdate:
         return self.tags
 
     def check_manifest_exist(self, depot_id, manifest_gid):
+        if self.use_manifest_index:
+            return f'{depot_id}_{manifest_gid}' in self.manifest_index
         for tag in set([i.name for i in self.repo.tags] + [*self.tags]):
             if f'{depot_id}_{manifest_gid}' == tag:
                 return True
         return False
 
+    def prefetch_app_repo(self, app_id_list):
+        remote_head = self.get_remote_head()
+        with lock:
+            app_id_list = [app_id for app_id in dict.fromkeys(map(str, app_id_list)) if app_id in remote_head
+                           and app_id not in self.fetched_app_set and not self.check_app_repo_local(app_id)]
+            if not app_id_list:
+                return
+            self.log.info(f'Prefetching {len(app_id_list)} app branches!')
+            for i in range(0, len(app_id_list), self.fetch_chunk_size):
+                chunk = app_id_list[i:i + self.fetch_chunk_size]
+                try:
+                    self.fetch('origin', *[f'{app_id}:origin_{app_id}' for app_id in chunk])
+                    self.fetched_app_set.update(chunk)
+                except git.exc.GitCommandError:
+                    for app_id in chunk:
+                        try:
+                            self.fetch('origin', f'{app_id}:origin_{app_id}')
+                            self.fetched_app_set.add(app_id)
+                        except git.exc.GitCommandError as e:
+                            self.log.warning(f'Prefetching app branch {app_id} failed: {e}')
+
     def init_app_repo(self, app_id):
         app_path = self.ROOT / f'depots/{app_id}'
         if str(app_id) not in self.get_app_worktree():
@@ -297,8 +440,9 @@ class ManifestAutoUpdate:
                 app_path.unlink(missing_ok=True)
             if self.check_app_repo_remote(app_id):
                 with lock:
-                    if not self.check_app_repo_local(app_id):
-                        self.repo.git.fetch('origin', f'{app_id}:origin_{app_id}')
+                    if str(app_id) not in self.fetched_app_set and not self.check_app_repo_local(app_id):
+                        self.fetch('origin', f'{app_id}:origin_{app_id}')
+                        self.fetched_app_set.add(str(app_id))
                 self.repo.git.worktree('add', '-b', app_id, app_path, f'origin_{app_id}')
             else:
                 if self.check_app_repo_local(app_id):
@@ -317,366 +461,426 @@ class ManifestAutoUpdate:
                 self.log.error(e)
                 return
 
-   def login(self, steam, username, password):
-    """
-    Logs in the user to the Steam client.
-
-    This function handles the login process for a given user, including handling two-factor authentication,
-    rate limiting, and other potential login issues. It also updates the user's status in the user_info
-    dictionary based on the login result.
-
-    Args:
-        steam (MySteamClient): The Steam client instance to use for logging in.
-        username (str): The username of the account to log in.
-        password (str): The password of the account to log in.
-
-    Returns:
-        EResult: The result of the login attempt, as an EResult enum value.
-    """
-    self.log.info(f'Logging in to account {username}!')
-    
-    # Retrieve the shared secret for two-factor authentication, if available
-    shared_secret = self.two_factor.get(username)
-    
-    # Set the username for the Steam client instance
-    steam.username = username
-    
-    # Attempt to relogin the user using the Steam client
-    result = steam.relogin()
-    
-    # Initialize the wait time before retrying the login
-    wait = 1
-    
-    # Check if the relogin attempt was not successful
-    if result != EResult.OK:
-        # Log a warning if the relogin failed for a reason other than a general failure
-        if result != EResult.Fail:
-            self.log.warning(f'User {username}: Relogin failure reason: {result.__repr__()}')
-        
-        # Handle rate limiting by waiting before attempting to login again
-        if result == EResult.RateLimitExceeded:
-            with lock:
-                time.sleep(wait)
-        
-        # Attempt to login with the provided username and password, including two-factor code if available
-        result = steam.login(username, password, steam.login_key, two_factor_code=generate_twofactor_code(
-            base64.b64decode(shared_secret)) if shared_secret else None)
-    
-    # Initialize the retry count for login attempts
-    count = self.retry_num
-    
-    # Loop until the login is successful or the retry count is exhausted
-    while result != EResult.OK and count:
-        # Use the command line to interactively log in if the CLI option is enabled
-        if self.cli:
-            with lock:
-                self.log.warning(f'Using the command line to interactively log in to account {username}!')
-                result = steam.cli_login(username, password)
-            break
-        
-        # Handle rate limiting by waiting before attempting to login again
-        elif result == EResult.RateLimitExceeded:
-            if not count:
-                break
-            with lock:
-                time.sleep(wait)
+    def iter_app_info(self, steam, app_id_list, username=None):
+        for i in range(0, len(app_id_list), self.app_info_chunk_size):
+            chunk = app_id_list[i:i + self.app_info_chunk_size]
+            fresh_resp = self.retry(steam.get_product_info, chunk, retry_num=self.retry_num, timeout=60)
+            if not fresh_resp:
+                logging.error(f'User {username}: Failed to get app info: {chunk[0]}-{chunk[-1]}!')
+                continue
+            apps = fresh_resp['apps']
+            yield [(app_id, app) for app_id in chunk if (app := apps.pop(app_id, None))]
+
+    def async_task(self, cdn, app_id, depot_id, manifest_gid, app_config=None, manifest_alias=None):
+        self.init_app_repo(app_id)
+        manifest_path = self.ROOT / f'depots/{app_id}/{depot_id}_{manifest_gid}.manifest'
+        if manifest_path.exists():
+            try:
+                app_repo = git.Repo(self.ROOT / f'depots/{app_id}')
+                manifest_commit = app_repo.git.rev_list('-1', str(app_id),
+                                                        f'{depot_id}_{manifest_gid}.manifest').strip()
+            except git.exc.GitCommandError:
+                manifest_path.unlink(missing_ok=True)
+            else:
+                self.log.info(f'Already got the manifest: {depot_id}_{manifest_gid}')
+                return Result(result=True, code=EResult.OK, app_id=app_id, depot_id=depot_id,
+                              manifest_gid=manifest_gid, manifest_commit=manifest_commit)
+        return get_manifest(cdn, app_id, depot_id, manifest_gid, True, self.ROOT, self.retry_num, app_config,
+                            self.key_store, self.compress, manifest_alias)
+
+    def login(self, steam, username, password):
+        """
+        Logs in the user to the Steam client.
+
+        This function handles the login process for a given user, including handling two-factor authentication,
+        rate limiting, and other potential login issues. It also updates the user's status in the user_info
+        dictionary based on the login result.
+
+        Args:
+            steam (MySteamClient): The Steam client instance to use for logging in.
+            username (str): The username of the account to log in.
+            password (str): The password of the account to log in.
+
+        Returns:
+            EResult: The result of the login attempt, as an EResult enum value.
+        """
+        self.log.info(f'Logging in to account {username}!')
+
+        # Retrieve the shared secret for two-factor authentication, if available
+        shared_secret = self.two_factor.get(username)
+
+        # Set the username for the Steam client instance
+        steam.username = username
+
+        # Attempt to relogin the user using the Steam client
+        result = steam.relogin()
+
+        # Initialize the wait time before retrying the login
+        wait = 1
+
+        # Check if the relogin attempt was not successful
+        if result != EResult.OK:
+            # Log a warning if the relogin failed for a reason other than a general failure
+            if result != EResult.Fail:
+                self.log.warning(f'User {username}: Relogin failure reason: {result.__repr__()}')
+
+            # Handle rate limiting by waiting before attempting to login again
+            if result == EResult.RateLimitExceeded:
+                with lock:
+                    time.sleep(wait)
+
+            # Attempt to login with the provided username and password, including two-factor code if available
             result = steam.login(username, password, steam.login_key, two_factor_code=generate_twofactor_code(
                 base64.b64decode(shared_secret)) if shared_secret else None)
-        
-        # Handle cases where the account is disabled or requires two-factor authentication
-        elif result in (EResult.AccountLogonDenied, EResult.AccountDisabled,
-                        EResult.AccountLoginDeniedNeedTwoFactor, EResult.PasswordUnset):
-            logging.warning(f'User {username} has been disabled!')
-            self.user_info[username]['enable'] = False
-            self.user_info[username]['status'] = result
-            break
-        
-        # Increment the wait time before the next retry and decrement the retry count
-        wait += 1
-        count -= 1
-        
-        # Log an error with the reason for the login failure
-        self.log.error(f'User {username}: Login failure reason: {result.__repr__()}')
-    
-    # Log a message if the login was successful
-    if result == EResult.OK:
-        self.log.info(f'User {username} login successfully!')
-    
-    # Log an error if the login was not successful
-    else:
-        self.log.error(f'User {username}: Login failure reason: {result.__repr__()}')
-    
-    # Return the result of the login attempt
-    return result
+
+        # Initialize the retry count for login attempts
+        count = self.retry_num
+
+        # Loop until the login is successful or the retry count is exhausted
+        while result != EResult.OK and count:
+            # Use the command line to interactively log in if the CLI option is enabled
+            if self.cli:
+                with lock:
+                    self.log.warning(f'Using the command line to interactively log in to account {username}!')
+                    result = steam.cli_login(username, password)
+                break
+
+            # Handle rate limiting by waiting before attempting to login again
+            elif result == EResult.RateLimitExceeded:
+                if not count:
+                    break
+                with lock:
+                    time.sleep(wait)
+                result = steam.login(username, password, steam.login_key, two_factor_code=generate_twofactor_code(
+                    base64.b64decode(shared_secret)) if shared_secret else None)
+
+            # Handle cases where the account is disabled or requires two-factor authentication
+            elif result in (EResult.AccountLogonDenied, EResult.AccountDisabled,
+                            EResult.AccountLoginDeniedNeedTwoFactor, EResult.PasswordUnset):
+                logging.warning(f'User {username} has been disabled!')
+                self.user_info[username]['enable'] = False
+                self.user_info[username]['status'] = result
+                break
+
+            # Increment the wait time before the next retry and decrement the retry count
+            wait += 1
+            count -= 1
+
+            # Log an error with the reason for the login failure
+            self.log.error(f'User {username}: Login failure reason: {result.__repr__()}')
+
+        # Log a message if the login was successful
+        if result == EResult.OK:
+            self.log.info(f'User {username} login successfully, connection setup took {steam.connect_time:.2f}s!')
+
+        # Log an error if the login was not successful
+        else:
+            self.log.error(f'User {username}: Login failure reason: {result.__repr__()}')
+
+        # Return the result of the login attempt
+        return result
 
     def get_manifest(self, username, password, sentry_name=None):
-    """
-    Retrieves the manifest for the specified user's Steam account.
-
-    This function handles the process of logging in to a Steam account, initializing the CDN client,
-    and fetching the manifest for the user's paid applications. It also manages the user's status and
-    updates the user_info dictionary accordingly.
-
-    Args:
-        username (str): The username of the Steam account.
-        password (str): The password of the Steam account.
-        sentry_name (str, optional): The name of the sentry file for the Steam account. Defaults to None.
-
-    Returns:
-        None
-    """
-    with lock:
-        # Initialize user information if it doesn't exist
-        if username not in self.user_info:
-            self.user_info[username] = {}
-            self.user_info[username]['app'] = []
-        
-        # Initialize update time if it doesn't exist
-        if 'update' not in self.user_info[username]:
-            self.user_info[username]['update'] = 0
-        
-        # Initialize enable status if it doesn't exist
-        if 'enable' not in self.user_info[username]:
-            self.user_info[username]['enable'] = True
-        
-        # Check if the user is disabled and log a warning if so
-        if not self.user_info[username]['enable']:
-            logging.warning(f'User {username} is disabled!')
+        """
+        Retrieves the manifest for the specified user's Steam account.
+
+        This function handles the process of logging in to a Steam account, initializing the CDN client,
+        and fetching the manifest for the user's paid applications. It also manages the user's status and
+        updates the user_info dictionary accordingly.
+
+        Args:
+            username (str): The username of the Steam account.
+            password (str): The password of the Steam account.
+            sentry_name (str, optional): The name of the sentry file for the Steam account. Defaults to None.
+
+        Returns:
+            None
+        """
+        with lock:
+            # Initialize user information if it doesn't exist
+            if username not in self.user_info:
+                self.user_info[username] = {}
+                self.user_info[username]['app'] = []
+
+            # Initialize update time if it doesn't exist
+            if 'update' not in self.user_info[username]:
+                self.user_info[username]['update'] = 0
+
+            # Initialize enable status if it doesn't exist
+            if 'enable' not in self.user_info[username]:
+                self.user_info[username]['enable'] = True
+
+            # Check if the user is disabled and log a warning if so
+            if not self.user_info[username]['enable']:
+                logging.warning(f'User {username} is disabled!')
+                return
+
+        # Calculate the time until the next update and log a warning if it's not time yet
+        t = self.user_info[username]['update'] + self.update_wait_time - time.time()
+        if t > 0:
+            logging.warning(f'User {username} interval from next update: {int(t)}s!')
             return
-    
-    # Calculate the time until the next update and log a warning if it's not time yet
-    t = self.user_info[username]['update'] + self.update_wait_time - time.time()
-    if t > 0:
-        logging.warning(f'User {username} interval from next update: {int(t)}s!')
-        return
-    
-    # Determine the path to the sentry file if provided
-    sentry_path = None
-    if sentry_name:
-        sentry_path = Path(
-            self.credential_location if self.credential_location else MySteamClient.credential_location) / sentry_name
-    
-    self.log.debug(f'User {username} sentry_path: {sentry_path}')
-    
-    # Initialize the Steam client with the sentry path
-    steam = MySteamClient(str(self.credential_location), sentry_path)
-    
-    # Attempt to log in the user
-    result = self.login(steam, username, password)
-    
-    # Return if the login was not successful
-    if result != EResult.OK:
-        return
-    
-    self.log.info(f'User {username}: Waiting to initialize the cdn client!')
-    
-    # Initialize the CDN client with retries
-    cdn = self.retry(MyCDNClient, steam, retry_num=self.retry_num)
-    
-    # Log an error and return if the CDN client initialization failed
-    if not cdn:
-        logging.error(f'User {username}: Failed to initialize cdn!')
-        return
-    
-    app_id_list = []
-    
-    # Fetch packages information if available
-    if cdn.packages_info:
-        self.log.info(f'User {username}: Waiting to get packages info!')
-        product_info = self.retry(steam.get_product_info, packages=cdn.packages_info, retry_num=self.retry_num)
-        
-        # Log an error and return if fetching packages info failed
-        if not product_info:
-            logging.error(f'User {username}: Failed to get packages info!')
+
+        # Determine the path to the sentry file if provided
+        sentry_path = None
+        if sentry_name:
+            sentry_path = Path(
+                self.credential_location if self.credential_location else MySteamClient.credential_location) / sentry_name
+
+        self.log.debug(f'User {username} sentry_path: {sentry_path}')
+
+        # Initialize the Steam client with the sentry path
+        steam = MySteamClient(str(self.credential_location), sentry_path)
+
+        # Attempt to log in the user
+        result = self.login(steam, username, password)
+
+        # Return if the login was not successful
+        if result != EResult.OK:
+            return
+
+        self.log.info(f'User {username}: Waiting to initialize the cdn client!')
+
+        # Initialize the CDN client with retries
+        cdn = self.retry(MyCDNClient, steam, retry_num=self.retry_num)
+
+        # Log an error and return if the CDN client initialization failed
+        if not cdn:
+            logging.error(f'User {username}: Failed to initialize cdn!')
             return
-        
-        # Collect app IDs for paid packages
+
+        # Collect app IDs for paid packages from the package info loaded with the licenses
+        app_id_list = []
         if cdn.packages_info:
-            for package_id, info in product_info['packages'].items():
+            for package_id, info in cdn.packages_info.items():
                 if 'depotids' in info and info['depotids'] and info['billingtype'] in BillingType.PaidList:
                     app_id_list.extend(list(info['appids'].values()))
-    
-    self.log.info(f'User {username}: {len(app_id_list)} paid app found!')
-    
-    # Disable the user if no paid apps were found
-    if not app_id_list:
-        self.user_info[username]['enable'] = False
-        self.user_info[username]['status'] = result
-        logging.warning(f'User {username}: Does not have any app and has been disabled!')
-        return
-    
-    self.log.debug(f'User {username}, paid app id list: ' + ','.join([str(i) for i in app_id_list]))
-    
-    self.log.info(f'User {username}: Waiting to get app info!')
-    
-    # Fetch detailed information for the collected app IDs
-    fresh_resp = self.retry(steam.get_product_info, app_id_list, retry_num=self.retry_num)
-    
-    # Log an error and return if fetching app info failed
-    if not fresh_resp:
-        logging.error(f'User {username}: Failed to get app info!')
-        return
-    
-    job_list = []
-    flag = True
-    
-    # Iterate over the app IDs to fetch manifests
-    for app_id in app_id_list:
-        if self.update_app_id_list and int(app_id) not in self.update_app_id_list:
-            continue
-        
-        with lock:
-            if int(app_id) in self.app_lock:
-                continue
-            self.log.debug(f'Lock app: {app_id}')
-            self.app_lock[int(app_id)] = set()
-        
-        app = fresh_resp['apps'][app_id]
-        
-        # Check if the app type is one of the supported types (game, DLC, application)
-        if 'common' in app and app['common']['type'].lower() in ['game', 'dlc', 'application']:
-            if 'depots' not in fresh_resp['apps'][app_id]:
-                continue
-            
-            # Iterate over the depots to fetch manifests
-            for depot_id, depot in fresh_resp['apps'][app_id]['depots'].items():
+            cdn.packages_info = None
+
+        self.log.info(f'User {username}: {len(app_id_list)} paid app found!')
+
+        # Disable the user if no paid apps were found
+        if not app_id_list:
+            self.user_info[username]['enable'] = False
+            self.user_info[username]['status'] = result
+            logging.warning(f'User {username}: Does not have any app and has been disabled!')
+            return
+
+        self.log.debug(f'User {username}, paid app id list: ' + ','.join([str(i) for i in app_id_list]))
+
+        if self.update_app_id_list:
+            app_id_list = [app_id for app_id in app_id_list if int(app_id) in self.update_app_id_list]
+
+        self.log.info(f'User {username}: Waiting to get app info!')
+
+        # Build the licensed id set once for the whole account
+        licensed_id_set = {*cdn.licensed_depot_ids, *cdn.licensed_app_ids}
+        job_list = []
+        flag = True
+
+        # Fetch app info chunk by chunk and start the manifest jobs as soon as each chunk arrives
+        for app_list in self.iter_app_info(steam, app_id_list, username):
+            pending_list = []
+            for app_id, app in app_list:
+                with lock:
+                    if int(app_id) in self.app_lock:
+                        continue
+                    self.log.debug(f'Lock app: {app_id}')
+                    self.app_lock[int(app_id)] = set()
+
+                # Check if the app type is one of the supported types (game, DLC, application)
+                if 'common' in app and app['common']['type'].lower() in ['game', 'dlc', 'application'] \
+                        and 'depots' in app:
+                    app_config = AppConfig(self.ROOT / f'depots/{app_id}')
+                    manifest_alias = ManifestAlias(self.ROOT / f'depots/{app_id}')
+                    app_job_list = []
+                    app_result_list = []
+
+                    # Iterate over the depots to fetch manifests
+                    for depot_id, depot in app['depots'].items():
+                        with lock:
+                            self.app_lock[int(app_id)].add(depot_id)
+
+                        if 'manifests' in depot and 'public' in depot['manifests'] and int(
+                                depot_id) in licensed_id_set:
+                            manifest_gid = depot['manifests']['public']
+                            self.set_depot_info(depot_id, manifest_gid)
+
+                            with lock:
+                                if int(app_id) not in self.user_info[username]['app']:
+                                    self.user_info[username]['app'].append(int(app_id))
+
+                                if self.check_manifest_exist(depot_id, manifest_gid):
+                                    self.log.info(f'Already got the manifest: {depot_id}_{manifest_gid}')
+                                    continue
+
+                            flag = False
+
+                            # Create a greenlet job to fetch the manifest asynchronously
+                            job = gevent.Greenlet(LogExceptions(self.async_task), cdn, app_id, depot_id, manifest_gid,
+                                                  app_config, manifest_alias)
+                            job.rawlink(functools.partial(self.get_manifest_callback, username, app_id, depot_id,
+                                                          manifest_gid, app_result_list))
+                            app_job_list.append(job)
+
+                    if app_job_list:
+                        pending_list.append((app_id, app_config, manifest_alias, app_job_list, app_result_list))
+
                 with lock:
-                    self.app_lock[int(app_id)].add(depot_id)
-                
-                if 'manifests' in depot and 'public' in depot['manifests'] and int(
-                        depot_id) in {*cdn.licensed_depot_ids, *cdn.licensed_app_ids}:
-                    manifest_gid = depot['manifests']['public']
-                    self.set_depot_info(depot_id, manifest_gid)
-                    
-                    with lock:
-                        if int(app_id) not in self.user_info[username]['app']:
-                            self.user_info[username]['app'].append(int(app_id))
-                        
-                        if self.check_manifest_exist(depot_id, manifest_gid):
-                            self.log.info(f'Already got the manifest: {depot_id}_{manifest_gid}')
-                            continue
-                    
-                    flag = False
-                    
-                    # Create a greenlet job to fetch the manifest asynchronously
-                    job = gevent.Greenlet(LogExceptions(self.async_task), cdn, app_id, depot_id, manifest_gid)
-                    job.rawlink(
-                        functools.partial(self.get_manifest_callback, username, app_id, depot_id, manifest_gid))
-                    job_list.append(job)
-                    gevent.idle()
-            
-            # Start all greenlet jobs
-            for job in job_list:
-                job.start()
-        
+                    if int(app_id) in self.app_lock and not self.app_lock[int(app_id)]:
+                        self.log.debug(f'Unlock app: {app_id}')
+                        self.app_lock.pop(int(app_id))
+
+            # Fetch the branches of all apps in this chunk at once before their jobs need the worktrees
+            self.prefetch_app_repo([app_id for app_id, *_ in pending_list])
+            for app_id, app_config, manifest_alias, app_job_list, app_result_list in pending_list:
+                for job in app_job_list:
+                    job.start()
+                job_list.extend(app_job_list)
+                job_list.append(gevent.spawn(self.save_app_config, app_id, app_config, manifest_alias, app_job_list,
+                                             app_result_list))
+            gevent.idle()
+
         with lock:
-            if int(app_id) in self.app_lock and not self.app_lock[int(app_id)]:
-                self.log.debug(f'Unlock app: {app_id}')
-                self.app_lock.pop(int(app_id))
-    
-    with lock:
-        if flag:
-            self.user_info[username]['update'] = int(time.time())
-    
-    # Wait for all greenlet jobs to complete
-    gevent.joinall(job_list)
+            if flag:
+                self.user_info[username]['update'] = int(time.time())
+
+        # Wait for all greenlet jobs to complete
+        gevent.joinall(job_list)
 
     def update(self):
-    """
-    Updates the list of users and applications that need to be updated.
-
-    This function identifies which users and applications require updates by checking the current state
-    of the application manifests against the latest available manifests. It then updates the internal
-    data structures to reflect which users and applications need to be processed during the next run.
-
-    Returns:
-        list: A list of usernames that need to be updated.
-    """
-    app_id_list = []
-    
-    # Collect all app IDs for users that are enabled
-    for user, info in self.user_info.items():
-        if info['enable']:
-            if info['app']:
-                app_id_list.extend(info['app'])
-    
-    # Remove duplicates from the app ID list
-    app_id_list = list(set(app_id_list))
-    
-    logging.debug(app_id_list)
-    
-    # Initialize the Steam client for anonymous login
-    steam = MySteamClient(str(self.credential_location))
-    
-    self.log.info('Logging in to anonymous!')
-    
-    # Perform anonymous login
-    steam.anonymous_login()
-    
-    self.log.info('Waiting to get all app info!')
-    
-    app_info_dict = {}
-    count = 0
-    
-    # Fetch detailed information for the collected app IDs in chunks
-    while app_id_list[count:count + 300]:
-        fresh_resp = self.retry(steam.get_product_info, app_id_list[count:count + 300],
-                                retry_num=self.retry_num, timeout=60)
-        count += 300
-        
-        if fresh_resp:
-            for app_id, info in fresh_resp['apps'].items():
-                if depots := info.get('depots'):
-                    app_info_dict[int(app_id)] = depots
-            self.log.info(f'Acquired {len(app_info_dict)} app info!')
-    
-    update_app_set = set()
-    
-    # Identify which apps need to be updated by comparing current manifests with the latest available
-    for app_id, app_info in app_info_dict.items():
-        for depot_id, depot in app_info.items():
-            if depot_id.isdecimal():
-                if manifests := depot.get('manifests'):
-                    if manifest := manifests.get('public'):
-                        if depot_id in self.app_info and self.app_info[depot_id] != manifest:
-                            update_app_set.add(app_id)
-    
-    update_app_user = {}
-    update_user_set = set()
-    
-    # Map apps that need updating to the users who have them
-    for user, info in self.user_info.items():
-        if info['enable'] and info['app']:
-            for app_id in info['app']:
-                if int(app_id) in update_app_set:
-                    if int(app_id) not in update_app_user:
-                        update_app_user[int(app_id)] = []
-                    update_app_user[int(app_id)].append(user)
-                    update_user_set.add(user)
-    
-    self.log.debug(str(update_app_user))
-    
-    # Add users who need to be updated to the update_user_list
-    for user in self.account_info:
-        if user not in self.user_info:
-            update_user_set.add(user)
-    
-    self.update_user_list.extend(list(update_user_set))
-    
-    # Log the apps and users that need to be updated
-    for app_id, user_list in update_app_user.items():
-        self.log.info(f'{app_id}: {",".join(user_list)}')
-    
-    self.log.info(f'{len(update_app_user)} app and {len(self.update_user_list)} users need to update!')
-    
-    return self.update_user_list
+        """
+        Updates the list of users and applications that need to be updated.
+
+        This function identifies which users and applications require updates by checking the current state
+        of the application manifests against the latest available manifests. It then updates the internal
+        data structures to reflect which users and applications need to be processed during the next run.
+
+        Returns:
+            list: A list of usernames that need to be updated.
+        """
+        app_id_list = []
+
+        # Collect all app IDs for users that are enabled
+        for user, info in self.user_info.items():
+            if info['enable']:
+                if info['app']:
+                    app_id_list.extend(info['app'])
+
+        # Remove duplicates from the app ID list
+        app_id_list = list(set(app_id_list))
+
+        logging.debug(app_id_list)
+
+        # Initialize the Steam client for anonymous login
+        steam = MySteamClient(str(self.credential_location))
+
+        self.log.info('Logging in to anonymous!')
+
+        # Perform anonymous login
+        steam.anonymous_login()
+
+        self.log.info('Waiting to get all app info!')
+
+        app_info_dict = {}
+        count = 0
+
+        # Fetch detailed information for the collected app IDs in chunks
+        while app_id_list[count:count + 300]:
+            fresh_resp = self.retry(steam.get_product_info, app_id_list[count:count + 300],
+                                    retry_num=self.retry_num, timeout=60)
+            count += 300
+
+            if fresh_resp:
+                for app_id, info in fresh_resp['apps'].items():
+                    if depots := info.get('depots'):
+                        app_info_dict[int(app_id)] = depots
+                self.log.info(f'Acquired {len(app_info_dict)} app info!')
+
+        update_app_set = set()
+
+        # Identify which apps need to be updated by comparing current manifests with the latest available
+        for app_id, app_info in app_info_dict.items():
+            for depot_id, depot in app_info.items():
+                if depot_id.isdecimal():
+                    if manifests := depot.get('manifests'):
+                        if manifest := manifests.get('public'):
+                            if depot_id in self.app_info and self.app_info[depot_id] != manifest:
+                                update_app_set.add(app_id)
+
+        update_app_user = {}
+        update_user_set = set()
+
+        # Map apps that need updating to the users who have them
+        for user, info in self.user_info.items():
+            if info['enable'] and info['app']:
+                for app_id in info['app']:
+                    if int(app_id) in update_app_set:
+                        if int(app_id) not in update_app_user:
+                            update_app_user[int(app_id)] = []
+                        update_app_user[int(app_id)].append(user)
+                        update_user_set.add(user)
+
+        self.log.debug(str(update_app_user))
+
+        # Add users who need to be updated to the update_user_list
+        for user in self.account_info:
+            if user not in self.user_info:
+                update_user_set.add(user)
+
+        self.update_user_list.extend(list(update_user_set))
+
+        # Log the apps and users that need to be updated
+        for app_id, user_list in update_app_user.items():
+            self.log.info(f'{app_id}: {",".join(user_list)}')
+
+        self.log.info(f'{len(update_app_user)} app and {len(self.update_user_list)} users need to update!')
+
+        return self.update_user_list
+
+    def run(self, update=False):
+        if not self.account_info or self.init_only:
+            self.save()
+            self.account_info.dump()
+            return
+        if update:
+            self.update()
+            if not self.update_user_list:
+                return
+        with Pool(self.pool_num) as pool:
+            pool: ThreadPool
+            result_list = []
+            for username in self.account_info:
+                if self.update_user_list and username not in self.update_user_list:
+                    self.log.debug(f'User {username} has skipped the update!')
+                    continue
+                password, sentry_name = self.account_info[username]
+                result_list.append(
+                    pool.apply_async(LogExceptions(self.get_manifest), (username, password, sentry_name)))
+            try:
+                while pool._state == 'RUN':
+                    if all([result.ready() for result in result_list]):
+                        self.log.info('The program will exit in 10 seconds!')
+                        time.sleep(10)
+                        break
+                    self.save()
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                with lock:
+                    pool.terminate()
+                os._exit(0)
+            finally:
+                self.save()
+                self.save_manifest_index()
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
     ManifestAutoUpdate(args.credential_location, level=args.level, pool_num=args.pool_num, retry_num=args.retry_num,
                        update_wait_time=args.update_wait_time, key=args.key, init_only=args.init_only,
-                       cli=args.cli, app_id_list=args.app_id_list, user_list=args.user_list).run(update=args.update)
+                       cli=args.cli, app_id_list=args.app_id_list, user_list=args.user_list,
+                       compress=args.compress, partial_clone=args.partial_clone, manifest_index=args.manifest_index,
+                       no_tags=args.no_tags).run(update=args.update)
     if not args.no_push:
         if not args.init_only:
             push()
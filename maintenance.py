@@ -0,0 +1,98 @@
+import git
+import time
+import logging
+import argparse
+from pathlib import Path
+
+
+class Maintenance:
+    log = logging.getLogger('Maintenance')
+    loose_refs_limit = 1000
+    loose_objects_limit = 6700
+    pack_limit = 20
+
+    def __init__(self, repo='.', level=None, force=False):
+        if level:
+            level = logging.getLevelName(level.upper())
+        else:
+            level = logging.INFO
+        logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s',
+                            level=level)
+        self.repo = git.Repo(repo)
+        self.git_dir = Path(self.repo.common_dir)
+        self.force = force
+
+    def count_loose_refs(self):
+        return sum(1 for i in (self.git_dir / 'refs').rglob('*') if i.is_file())
+
+    def count_objects(self):
+        return dict(i.split(': ') for i in self.repo.git.count_objects('-v').split('\n'))
+
+    def count_prunable_worktree(self):
+        count = 0
+        worktrees_path = self.git_dir / 'worktrees'
+        if worktrees_path.is_dir():
+            for i in worktrees_path.iterdir():
+                gitdir_path = i / 'gitdir'
+                if not gitdir_path.is_file() or not Path(gitdir_path.read_text().strip()).exists():
+                    count += 1
+        return count
+
+    def get_timing_dict(self):
+        timing_dict = {}
+        tag = self.repo.git.for_each_ref('--sort=-creatordate', '--count=1', '--format=%(refname:short)',
+                                         'refs/tags').strip()
+        task_list = [('for-each-ref', lambda: self.repo.git.for_each_ref('refs/heads', 'refs/tags')),
+                     ('tag', lambda: self.repo.git.tag()),
+                     ('rev-list --all', lambda: self.repo.git.rev_list('--all', '--count'))]
+        if tag:
+            task_list.append(('branch --contains', lambda: self.repo.git.branch('-a', '--contains', tag)))
+        for name, fun in task_list:
+            start = time.time()
+            fun()
+            timing_dict[name] = time.time() - start
+        return timing_dict
+
+    def run_task(self, name, *args):
+        self.log.info(f'Running git {name}!')
+        start = time.time()
+        try:
+            self.repo.git.execute(['git', name, *args])
+        except git.exc.GitCommandError as e:
+            self.log.warning(f'git {name} failed: {e}')
+            return False
+        self.log.info(f'git {name} finished in {time.time() - start:.2f}s!')
+        return True
+
+    def run(self):
+        before = self.get_timing_dict()
+        loose_refs = self.count_loose_refs()
+        objects = self.count_objects()
+        self.log.info(f'{loose_refs} loose refs, {objects["count"]} loose objects, {objects["packs"]} packs')
+        if self.force or loose_refs > self.loose_refs_limit:
+            self.run_task('pack-refs', '--all', '--prune')
+        repacked = False
+        if self.force or int(objects['count']) > self.loose_objects_limit or int(objects['packs']) > self.pack_limit:
+            repacked = self.run_task('repack', '-d', '-l', '--geometric=2')
+        if int(self.count_objects()['packs']) and (
+                self.force or repacked or not (self.git_dir / 'objects/pack/multi-pack-index').exists()):
+            self.run_task('multi-pack-index', 'write')
+        if self.force or repacked or not ((self.git_dir / 'objects/info/commit-graph').exists() or (
+                self.git_dir / 'objects/info/commit-graphs').exists()):
+            self.run_task('commit-graph', 'write', '--reachable', '--split')
+        if self.count_prunable_worktree():
+            self.run_task('worktree', 'prune')
+        after = self.get_timing_dict()
+        print(f'{"operation":<20}{"before":>12}{"after":>12}')
+        for name, t in before.items():
+            print(f'{name:<20}{t:>11.3f}s{after[name]:>11.3f}s')
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-r', '--repo', default='.')
+parser.add_argument('-f', '--force', action='store_true', default=False)
+parser.add_argument('-l', '--level', default='INFO')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    Maintenance(repo=args.repo, level=args.level, force=args.force).run()
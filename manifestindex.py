@@ -0,0 +1,135 @@
+import git
+import logging
+import argparse
+from io import BytesIO
+from pathlib import Path
+from gitdb import IStream
+from threading import Lock
+from push import PushJournal
+from git.objects import Blob, Tree
+from git.objects.fun import tree_to_stream
+
+
+class ManifestIndex:
+    log = logging.getLogger('ManifestIndex')
+    ref = 'refs/meta/manifests'
+    file_name = 'manifests'
+
+    def __init__(self, repo=None, load=True):
+        self.repo = repo or git.Repo()
+        self.lock = Lock()
+        self.manifest_dict = {}
+        self.remote_sha_list = []
+        if load:
+            self.load()
+
+    def __contains__(self, name):
+        return name in self.manifest_dict
+
+    def __len__(self):
+        return len(self.manifest_dict)
+
+    @staticmethod
+    def get_remote_ref(remote):
+        return f'refs/remotes/{remote}/meta/manifests'
+
+    def read(self, rev):
+        try:
+            sha = self.repo.git.rev_parse('--verify', '-q', f'{rev}^{{commit}}').strip()
+            data = self.repo.git.cat_file('blob', f'{sha}:{self.file_name}')
+        except git.exc.GitCommandError:
+            return None, {}
+        return sha, dict(i.split() for i in data.split('\n') if i)
+
+    def load(self, rev=None):
+        sha, manifest_dict = self.read(rev or self.ref)
+        with self.lock:
+            for name, app_id in manifest_dict.items():
+                self.manifest_dict.setdefault(name, app_id)
+        return sha
+
+    def fetch(self, remote='origin'):
+        try:
+            self.repo.git.fetch(remote, f'+{self.ref}:{self.get_remote_ref(remote)}')
+        except git.exc.GitCommandError as e:
+            self.log.debug(f'Fetching the manifest index from {remote} failed: {e}')
+            return False
+        if sha := self.load(self.get_remote_ref(remote)):
+            with self.lock:
+                if sha not in self.remote_sha_list:
+                    self.remote_sha_list.append(sha)
+        return True
+
+    def add(self, depot_id, manifest_gid, app_id):
+        with self.lock:
+            self.manifest_dict[f'{depot_id}_{manifest_gid}'] = str(app_id)
+
+    def get_app_set(self, other):
+        return set(int(app_id) for name, app_id in self.manifest_dict.items() if name not in other)
+
+    def store(self, type_, data):
+        return self.repo.odb.store(IStream(type_, len(data), BytesIO(data))).binsha
+
+    def commit(self, message='Update manifest index'):
+        sha = self.read(self.ref)[0]
+        parent_list = [sha] if sha else []
+        for remote_sha in self.remote_sha_list:
+            if remote_sha not in parent_list and not (sha and self.repo.is_ancestor(remote_sha, sha)):
+                parent_list.append(remote_sha)
+        with self.lock:
+            manifest_dict = dict(self.manifest_dict)
+        if not parent_list and not manifest_dict:
+            return
+        # Fast-forward instead of committing when nothing was added on top of a single parent
+        if len(parent_list) == 1 and self.read(parent_list[0])[1] == manifest_dict:
+            if parent_list[0] != sha:
+                self.repo.git.update_ref(self.ref, parent_list[0], sha or '0' * 40)
+                return parent_list[0]
+            return
+        data = ''.join(f'{name} {manifest_dict[name]}\n' for name in sorted(manifest_dict)).encode()
+        f = BytesIO()
+        tree_to_stream([(self.store(Blob.type, data), Blob.file_mode, self.file_name)], f.write)
+        commit = git.Commit.create_from_tree(self.repo, Tree(self.repo, self.store(Tree.type, f.getvalue())), message,
+                                             parent_commits=[git.Commit(self.repo, bytes.fromhex(i))
+                                                             for i in parent_list])
+        self.repo.git.update_ref(self.ref, commit.hexsha, sha or '0' * 40)
+        self.log.info(f'Manifest index updated: {len(manifest_dict)} manifests')
+        return commit.hexsha
+
+    def import_tags(self):
+        commit_branch_dict = {}
+        for i in filter(None, self.repo.git.log('--source', '--branches', '--remotes', '--format=%H %S').split('\n')):
+            sha, refs = i.split()
+            name = refs.split('/')[-1]
+            commit_branch_dict[sha] = name[7:] if name.startswith('origin_') else name
+        count = 0
+        for i in filter(None, self.repo.git.for_each_ref('--format=%(refname:short) %(objectname) %(*objectname)',
+                                                         'refs/tags').split('\n')):
+            tag, *sha_list = i.split()
+            if '_' not in tag or tag in self:
+                continue
+            if (app_id := commit_branch_dict.get(sha_list[-1])) and app_id.isdecimal():
+                self.add(*tag.split('_', 1), app_id)
+                count += 1
+            else:
+                self.log.debug(f'Can\'t find the branch to which the tag belongs: {tag}')
+        self.log.info(f'Imported {count} tags!')
+        return count
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-r', '--repo', default='.')
+parser.add_argument('-i', '--import-tags', action='store_true', default=False)
+parser.add_argument('-l', '--level', default='INFO')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s',
+                        level=logging.getLevelName(args.level.upper()))
+    repo = git.Repo(args.repo)
+    manifest_index = ManifestIndex(repo)
+    manifest_index.fetch()
+    if args.import_tags:
+        manifest_index.import_tags()
+    if manifest_index.commit():
+        PushJournal(Path(repo.working_dir) / 'data').add(ManifestIndex.ref)
@@ -1,137 +1,238 @@
 import git
 import vdf
-import shutil
-import struct
 import logging
+import sqlite3
 import argparse
-import requests
 import traceback
+import subprocess
+from io import BytesIO
 from main import MyJson
+from github import GitHub
 from pathlib import Path
-from binascii import crc32
-from steam.core.manifest import DepotManifest
+from gitdb import IStream
+from catfile import CatFile
+from threading import Lock
+from push import PushJournal
+from git.objects import Blob, Tree
+from manifestindex import ManifestIndex
+from git.objects.fun import tree_to_stream
+from multiprocessing.dummy import Pool
+from DepotManifestGen.main import get_metadata, DepotKeyStore, load_manifest_alias, dump_manifest_alias
 
 
-class Depot:
+def update_ref(repo, command_list):
+    subprocess.run(['git', 'update-ref', '--stdin'], input='\n'.join(command_list) + '\n', check=True,
+                   cwd=repo.working_dir, universal_newlines=True, stderr=subprocess.PIPE)
+
+
+class ManifestMetadataCache:
 
-    def __init__(self, path, app_info=None, author=None):
+    def __init__(self, path):
         self.path = Path(path)
-        self.repo = git.Repo(self.path)
-        self.commit_list = self.get_all_commit()
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS manifest_metadata (sha TEXT PRIMARY KEY, '
+                              'depot_id INTEGER NOT NULL, manifest_gid TEXT NOT NULL, '
+                              'creation_time INTEGER NOT NULL, crc_ok INTEGER NOT NULL)')
+
+    def get(self, sha):
+        with self.lock:
+            row = self.conn.execute('SELECT depot_id, manifest_gid, creation_time, crc_ok FROM manifest_metadata '
+                                    'WHERE sha = ?', (sha,)).fetchone()
+        if row:
+            return row[0], int(row[1]), row[2], bool(row[3])
+
+    def set(self, sha, depot_id, manifest_gid, creation_time, crc_ok):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO manifest_metadata '
+                              '(sha, depot_id, manifest_gid, creation_time, crc_ok) VALUES (?, ?, ?, ?, ?)',
+                              (sha, int(depot_id), str(manifest_gid), int(creation_time), int(crc_ok)))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class Depot:
+
+    def __init__(self, repo, rev, cat_file, app_info=None, author=None, key_store=None, journal=None,
+                 metadata_cache=None, manifest_index=None):
+        self.repo = repo
+        self.rev = rev
+        self.cat_file = cat_file
+        self.commit_sha = self.cat_file.read(rev)[0]
+        self.tree_dict = {name: (binsha, mode) for binsha, mode, name in self.cat_file.tree(rev)}
+        self.metadata_cache = metadata_cache
+        self.author_dict = self.get_all_author()
+        self.config = self.get_config()
+        self.alias_dict = self.get_alias()
         self.depot_key_dict = self.get_all_depot_key()
         self.depot_dict = self.get_all_manifest()
         self.app_info = app_info
         self.author = author
+        self.key_store = key_store
+        self.journal = journal
+        self.manifest_index = manifest_index
 
-    def get_all_depot_key(self):
-        depot_key_dict = dict()
-        config_path = self.path / 'config.vdf'
+    def get_config(self):
         try:
-            if config_path.exists():
-                with config_path.open() as f:
-                    config = vdf.load(f)
-                if 'depots' in config and type(config['depots']) is dict:
-                    for i, j in config['depots'].items():
-                        if type(j) is dict and 'DecryptionKey' in j and j['DecryptionKey']:
-                            depot_key_dict[int(i)] = j['DecryptionKey']
+            if entry := self.tree_dict.get('config.vdf'):
+                return vdf.loads(self.cat_file.read(entry[0].hex())[2].decode())
         except:
             traceback.print_exc()
+        return vdf.VDFDict()
+
+    def get_alias(self):
+        try:
+            if entry := self.tree_dict.get('alias.txt'):
+                return load_manifest_alias(self.cat_file.read(entry[0].hex())[2].decode())
+        except:
+            traceback.print_exc()
+        return {}
+
+    def get_all_depot_key(self):
+        depot_key_dict = dict()
+        if 'depots' in self.config and type(self.config['depots']) is dict:
+            for i, j in self.config['depots'].items():
+                if type(j) is dict and 'DecryptionKey' in j and j['DecryptionKey']:
+                    depot_key_dict[int(i)] = j['DecryptionKey']
         return depot_key_dict
 
-    def get_all_commit(self, commit=None):
-        commit_list = []
-        if not commit:
-            commit = self.repo.head.commit
-        if commit:
-            commit_list.append(commit)
-        if commit.parents:
-            commit_list.extend(self.get_all_commit(commit.parents[0]))
-        return commit_list
+    def get_all_author(self):
+        author_dict = {}
+        author = None
+        try:
+            result = self.repo.git.log('-m', '--first-parent', '--name-only', '--format=%x00%an%x00%ae', self.rev)
+        except git.exc.GitCommandError:
+            return author_dict
+        for line in result.split('\n'):
+            if line.startswith('\x00'):
+                _, name, email = line.split('\x00')
+                author = git.Actor(name, email)
+            elif line and line not in author_dict:
+                author_dict[line] = author
+        return author_dict
 
     def get_manifest_author(self, manifest_name):
-        if self.commit_list:
-            for i in self.commit_list:
-                if manifest_name in i.stats.files:
-                    return i.author
+        return self.author_dict.get(manifest_name)
+
+    def get_all_manifest_info(self):
+        info_dict = {}
+        sha_dict = {}
+        for name, (binsha, mode) in self.tree_dict.items():
+            if name.endswith('.manifest') and mode != Tree.tree_id << 12:
+                sha = binsha.hex()
+                if self.metadata_cache is not None and (info := self.metadata_cache.get(sha)):
+                    info_dict[name] = info
+                else:
+                    sha_dict[sha] = name
+        for sha, result in self.cat_file.iter_read(sha_dict):
+            try:
+                metadata, crc_clear = get_metadata(result[2])
+                info = metadata.depot_id, metadata.gid_manifest, metadata.creation_time, metadata.crc_clear == crc_clear
+                if self.metadata_cache is not None:
+                    self.metadata_cache.set(sha, *info)
+                info_dict[sha_dict[sha]] = info
+            except:
+                traceback.print_exc()
+        return info_dict
 
     def get_all_manifest(self):
         depot_dict = dict()
-        for i in self.path.iterdir():
-            if i.suffix == '.manifest':
-                try:
-                    with i.open('rb') as f:
-                        manifest = DepotManifest(f.read())
-                    buffer = manifest.payload.SerializeToString()
-                    crc_clear = crc32(struct.pack('<I', len(buffer)) + buffer)
-                    if manifest.metadata.crc_clear != crc_clear:
-                        manifest.metadata.crc_clear = crc_clear
-                    depot_id = int(manifest.depot_id)
-                    if depot_id in self.depot_key_dict:
-                        depot_key = self.depot_key_dict[depot_id]
-                        if len(depot_key) == 64:
-                            author = self.get_manifest_author(i.name)
-                            if author and author.name == 'github-actions[bot]':
-                                author = None
-                            depot_dict[depot_id] = (depot_key, manifest, i, author)
-                except:
-                    traceback.print_exc()
+        for name, (depot_id, manifest_gid, creation_time, crc_ok) in self.get_all_manifest_info().items():
+            if not crc_ok:
+                logging.debug(f'crc_clear mismatch: {name}')
+            if depot_id in self.depot_key_dict:
+                depot_key = self.depot_key_dict[depot_id]
+                if len(depot_key) == 64:
+                    author = self.get_manifest_author(name)
+                    if author and author.name == 'github-actions[bot]':
+                        author = None
+                    depot_dict[depot_id] = (depot_key, manifest_gid, creation_time, name, author)
         return depot_dict
 
-    def merge_depot_key(self, depot_id, depot_key):
-        config_path = self.path / 'config.vdf'
-        if config_path.exists():
-            with config_path.open() as f:
-                config = vdf.load(f)
-        else:
-            config = vdf.VDFDict()
-        if 'depots' not in config:
-            config['depots'] = {}
-        depots = config['depots']
-        if str(depot_id) not in depots:
-            depots[str(depot_id)] = {'DecryptionKey': depot_key}
-        with config_path.open('w') as f:
-            vdf.dump(config, f, pretty=True)
-
-    def merge(self, depot_id, manifest_gid, manifest_path, depot_key, author):
-        author_name = None
-        author_email = None
-        if author:
-            author_name = author.name
-            author_email = author.email
-        elif self.author:
-            author_name = self.author.name
-            author_email = self.author.email
-        shutil.copy(manifest_path, self.path / f'{depot_id}_{manifest_gid}.manifest')
-        self.merge_depot_key(depot_id, depot_key)
-        self.repo.git.add(f'{depot_id}_{manifest_gid}.manifest')
-        self.repo.git.add('config.vdf')
-        if author_name:
-            args = ['-c', f'user.name={author_name}']
-            if author_email:
-                args.extend(['-c', f'user.email={author_email}'])
-            self.repo.git.execute(['git', *args, 'commit', '-m', f'Update depot: {depot_id}_{manifest_gid}'])
-        else:
-            self.repo.git.commit('-m', f'Update depot: {depot_id}_{manifest_gid}')
-        self.repo.git.tag(f'{depot_id}_{manifest_gid}')
-        if self.app_info:
-            self.app_info[str(depot_id)] = manifest_gid
+    def store(self, type_, data):
+        return self.repo.odb.store(IStream(type_, len(data), BytesIO(data))).binsha
+
+    def write_tree(self, entry_dict):
+        entry_list = sorted(((binsha, mode, name) for name, (binsha, mode) in entry_dict.items()),
+                            key=lambda x: (x[2] + '/' if x[1] == Tree.tree_id << 12 else x[2]).encode())
+        f = BytesIO()
+        tree_to_stream(entry_list, f.write)
+        return Tree(self.repo, self.store(Tree.type, f.getvalue()))
 
-    def merge_depot(self, other):
+    def merge_depot(self, other, branch):
         other: Depot
+        entry_dict = dict(self.tree_dict)
+        if 'depots' not in self.config:
+            self.config['depots'] = {}
+        depots = self.config['depots']
+        merged_list = []
         for depot_id, args in other.depot_dict.items():
-            depot_key_other, manifest_other, manifest_path_other, author_other = args
-            try:
-                if depot_id not in self.depot_dict:
-                    self.merge(depot_id, manifest_other.gid, manifest_path_other, depot_key_other, author_other)
-                else:
-                    depot_key, manifest, manifest_path, author = self.depot_dict[depot_id]
-                    if manifest.gid != manifest_other.gid:
-                        if manifest.creation_time < manifest_other.creation_time:
-                            manifest_path.unlink(missing_ok=True)
-                            self.repo.git.add(manifest_path)
-                            self.merge(depot_id, manifest_other.gid, manifest_path_other, depot_key_other, author_other)
-            except:
-                traceback.print_exc()
+            depot_key_other, manifest_gid_other, creation_time_other, manifest_name_other, author_other = args
+            if depot_id in self.depot_dict:
+                depot_key, manifest_gid, creation_time, manifest_name, author = self.depot_dict[depot_id]
+                if manifest_gid == manifest_gid_other or creation_time >= creation_time_other:
+                    continue
+                entry_dict.pop(manifest_name, None)
+            entry_dict[f'{depot_id}_{manifest_gid_other}.manifest'] = other.tree_dict[manifest_name_other]
+            if str(depot_id) not in depots:
+                depots[str(depot_id)] = {'DecryptionKey': depot_key_other}
+            merged_list.append((depot_id, manifest_gid_other, depot_key_other, author_other))
+        # Content-identical manifests only exist as aliases of a manifest the branch already has
+        alias_dict = {name: target for name, target in other.alias_dict.items() if name not in self.alias_dict and (
+                f'{target}.manifest' in entry_dict or self.cat_file.read(f'refs/tags/{target}')
+                and not self.cat_file.read(f'refs/tags/{name}'))}
+        if not merged_list and not alias_dict:
+            return []
+        # alias.txt only keeps the current gid of each depot whose aliased file is in the tree, like main.py writes it
+        depot_set = set(str(depot_id) for depot_id, *_ in merged_list) | set(i.split('_', 1)[0] for i in alias_dict)
+        tree_alias_dict = {name: target for name, target in self.alias_dict.items()
+                           if name.split('_', 1)[0] not in depot_set}
+        tree_alias_dict.update((name, target) for name, target in alias_dict.items()
+                               if f'{target}.manifest' in entry_dict)
+        if tree_alias_dict != self.alias_dict:
+            if tree_alias_dict:
+                entry_dict['alias.txt'] = (self.store(Blob.type, dump_manifest_alias(tree_alias_dict).encode()),
+                                           Blob.file_mode)
+            else:
+                entry_dict.pop('alias.txt', None)
+        tag_list = [f'{depot_id}_{manifest_gid}' for depot_id, manifest_gid, *_ in merged_list] + [*alias_dict]
+        new_tag_list = [tag for tag in tag_list if not self.cat_file.read(f'refs/tags/{tag}')]
+        command_list = []
+        ref_list = [f'refs/tags/{tag}' for tag in new_tag_list]
+        if merged_list or tree_alias_dict != self.alias_dict:
+            entry_dict['config.vdf'] = (self.store(Blob.type, vdf.dumps(self.config, pretty=True).encode()),
+                                        Blob.file_mode)
+            author_set = set((i.name, i.email) for *_, i in merged_list if i)
+            author = git.Actor(*author_set.pop()) if len(author_set) == 1 else self.author
+            if not author or not author.name:
+                author = None
+            message = f'Update depot: {tag_list[0]}' if len(tag_list) == 1 else f'Update depots: {", ".join(tag_list)}'
+            commit = git.Commit.create_from_tree(self.repo, self.write_tree(entry_dict), message,
+                                                 parent_commits=[git.Commit(self.repo, bytes.fromhex(self.commit_sha))],
+                                                 author=author, committer=author)
+            old_sha = (self.cat_file.read(f'refs/heads/{branch}') or ['0' * 40])[0]
+            command_list.append(f'update refs/heads/{branch} {commit.hexsha} {old_sha}')
+            ref_list.insert(0, f'refs/heads/{branch}')
+            self.commit_sha = commit.hexsha
+            self.alias_dict = tree_alias_dict
+        # Aliases of manifests only tagged upstream are tagged without changing the tree
+        command_list.extend(f'create refs/tags/{tag} {self.commit_sha}' for tag in new_tag_list)
+        if command_list:
+            update_ref(self.repo, command_list)
+        if self.journal and ref_list:
+            self.journal.add(*ref_list)
+        if self.manifest_index is not None:
+            for tag in tag_list:
+                self.manifest_index.add(*tag.split('_', 1), branch)
+        for depot_id, manifest_gid, depot_key, _ in merged_list:
+            if self.app_info is not None:
+                self.app_info[str(depot_id)] = manifest_gid
+            if self.key_store is not None:
+                self.key_store.set(depot_id, depot_key)
+        return tag_list
 
 
 class Merge:
@@ -139,8 +240,13 @@ class Merge:
     log = logging.getLogger('Merge')
     app_info_path = ROOT / Path('appinfo.json')
     app_info = MyJson(app_info_path)
+    depot_key_path = ROOT / Path('depotkeys.db')
+    github_cache_path = ROOT / Path('github.db')
+    metadata_cache_path = ROOT / Path('manifest_metadata.db')
+    pool_num = 8
+    fetch_chunk_size = 200
 
-    def __init__(self, token, level=None):
+    def __init__(self, token, level=None, pool_num=None, api_url=None, graphql=False):
         if level:
             level = logging.getLevelName(level.upper())
         else:
@@ -148,43 +254,19 @@ class Merge:
         logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s',
                             level=level)
         self.repo = git.Repo()
+        self.journal = PushJournal(self.ROOT)
+        self.metadata_cache = ManifestMetadataCache(self.metadata_cache_path)
         self.remote_head_dict = self.get_remote_head()
         self.repo_url = '/'.join(self.repo.git.remote('get-url', 'origin').split('/')[-2:])
-        self.headers = {'Accept': 'application/vnd.github+json',
-                        'Authorization': f'Bearer {token}', 'X-GitHub-Api-Version': '2022-11-28'}
+        self.github = GitHub(token, self.github_cache_path, api_url, graphql)
         self.pr_list = self.get_all_pr()
-        self.local_heads = [i.name for i in self.repo.heads]
-        self.author_name = None
-        self.author_email = None
-
-    def get_user_email(self):
-        if not self.author_name:
-            return
-        url = f'https://api.github.com/users/{self.author_name}/events/public'
-        r = requests.get(url, headers=self.headers)
-        email_set = set()
-        for i in r.json():
-            if not (payload := i.get('payload')):
-                continue
-            if not (commits := payload.get('commits')):
-                continue
-            for commit in commits:
-                if not (author := commit.get('author')):
-                    continue
-                if not (name := author.get('name')):
-                    continue
-                if name != self.author_name:
-                    continue
-                if not (email := author.get('email')):
-                    continue
-                email_set.add(email)
-        if len(email_set) == 1:
-            return email_set.pop()
-        elif len(email_set) > 1:
-            for i in email_set:
-                if not i.endswith('@users.noreply.github.com'):
-                    return i
-            return email_set.pop()
+        self.key_store = DepotKeyStore(self.depot_key_path)
+        self.pool_num = pool_num or self.pool_num
+        self.local_heads = set(i.name for i in self.repo.heads)
+        self.email_dict = {}
+        self.manifest_index = ManifestIndex(self.repo)
+        if not self.manifest_index.fetch() and not self.manifest_index.read(ManifestIndex.ref)[0]:
+            self.manifest_index = None
 
     def get_remote_head(self):
         head_dict = {}
@@ -195,78 +277,163 @@ class Merge:
         return head_dict
 
     def get_all_pr(self):
-        pr_list = []
-        page = 1
         self.log.info('Getting pr list!')
-        while True:
-            url = f'https://api.github.com/repos/{self.repo_url}/pulls?per_page=100&page={page}'
-            r = requests.get(url, headers=self.headers)
-            if not r.json():
-                break
-            pr_list.extend(r.json())
-            page += 1
-        return pr_list
-
-    def get_head(self, name):
-        for i in self.repo.heads:
-            if i.name == name:
-                return i
-
-    def merge(self, num, app_id):
-        head_name = f'pr{app_id}'
-        origin_head_name = f'origin_{head_name}'
-        if origin_head_name not in self.local_heads:
-            self.repo.git.fetch('origin', f'pull/{num}/head:{origin_head_name}')
-        if head_name not in self.local_heads:
-            self.repo.git.worktree('add', '-b', head_name, self.ROOT / 'depots' / head_name, origin_head_name)
-        pr_repo = self.get_head(head_name)
-        depot = Depot(self.ROOT / 'depots' / head_name, app_info=self.app_info)
-        if app_id not in self.local_heads:
-            if app_id in self.remote_head_dict:
-                sha = self.remote_head_dict[app_id]
-                if sha == pr_repo.commit.hexsha:
-                    return
-                if f'origin_{app_id}' not in self.local_heads:
-                    self.repo.git.fetch('origin', f'{app_id}:origin_{app_id}')
-                self.repo.git.worktree('add', '-b', app_id, self.ROOT / 'depots' / app_id, f'origin_{app_id}')
-            else:
-                self.repo.git.worktree('add', '-b', app_id, self.ROOT / 'depots' / app_id, 'app')
-        source_depot = Depot(self.ROOT / 'depots' / app_id, app_info=self.app_info,
-                             author=git.Actor(self.author_name, self.author_email))
-        source_depot.merge_depot(depot)
+        return self.github.get_all_pr(self.repo_url)
+
+    def get_author(self, user):
+        author_name = user['login']
+        if not author_name:
+            return git.Actor(None, None)
+        if author_name not in self.email_dict:
+            self.email_dict[author_name] = self.github.get_user_email(author_name, user['id'])
+        return git.Actor(author_name, self.email_dict[author_name])
+
+    def fetch_all(self, app_pr_dict):
+        refspec_list = []
+        for app_id, pr_list in app_pr_dict.items():
+            for num, _ in pr_list:
+                if f'origin_pr_{num}' not in self.local_heads:
+                    refspec_list.append(f'pull/{num}/head:origin_pr_{num}')
+            if app_id not in self.local_heads and app_id in self.remote_head_dict and \
+                    f'origin_{app_id}' not in self.local_heads:
+                refspec_list.append(f'{app_id}:origin_{app_id}')
+        self.fetch(refspec_list)
+
+    def fetch(self, refspec_list):
+        if not refspec_list:
+            return
+        self.log.info(f'Fetching {len(refspec_list)} refs!')
+        for i in range(0, len(refspec_list), self.fetch_chunk_size):
+            chunk = refspec_list[i:i + self.fetch_chunk_size]
+            try:
+                self.repo.git.fetch('origin', *chunk)
+            except git.exc.GitCommandError:
+                for refspec in chunk:
+                    try:
+                        self.repo.git.fetch('origin', refspec)
+                    except git.exc.GitCommandError:
+                        traceback.print_exc()
+        self.local_heads = set(i.name for i in self.repo.heads)
+
+    def unpack_batch(self, cat_file, num):
+        part_list = []
+        commit = f'origin_pr_{num}'
+        author = git.Actor(*self.repo.git.log('-1', '--format=%an%x00%ae', commit).split('\x00'))
+        command_list = []
+        for binsha, mode, app_id in cat_file.tree(commit):
+            if mode != Tree.tree_id << 12 or not app_id.isdecimal():
+                continue
+            part_commit = git.Commit.create_from_tree(self.repo, Tree(self.repo, binsha), f'Batch pr {num}: {app_id}',
+                                                      parent_commits=[], author=author)
+            command_list.append(f'update refs/heads/origin_pr_{num}_{app_id} {part_commit.hexsha}')
+            part_list.append((app_id, f'{num}_{app_id}'))
+        if command_list:
+            update_ref(self.repo, command_list)
+        return part_list
+
+    def merge(self, repo, cat_file, num, app_id, author, app_info):
+        pr_head_name = f'origin_pr_{num}'
+        if app_id in self.local_heads:
+            rev = app_id
+        elif app_id in self.remote_head_dict:
+            if self.remote_head_dict[app_id] == cat_file.read(pr_head_name)[0]:
+                return
+            rev = f'origin_{app_id}'
+        else:
+            rev = 'app'
+        depot = Depot(repo, pr_head_name, cat_file, metadata_cache=self.metadata_cache)
+        source_depot = Depot(repo, rev, cat_file, app_info=app_info, author=author, key_store=self.key_store,
+                             journal=self.journal, metadata_cache=self.metadata_cache,
+                             manifest_index=self.manifest_index)
+        if source_depot.merge_depot(depot, app_id):
+            self.local_heads.add(app_id)
 
     def close_pr(self, num):
-        url = f'https://api.github.com/repos/{self.repo_url}/pulls/{num}'
-        requests.patch(url, headers=self.headers, json={'state': 'closed'})
+        try:
+            self.github.close_pr(self.repo_url, num)
+        except:
+            traceback.print_exc()
+
+    def delete_branch(self, branch):
+        try:
+            self.github.delete_branch(self.repo_url, branch)
+        except:
+            traceback.print_exc()
+
+    def merge_app(self, app_id, pr_list):
+        app_info = {}
+        merged_list = []
+        repo = git.Repo(self.repo.working_dir)
+        cat_file = CatFile(self.repo.working_dir)
+        for num, author in pr_list:
+            try:
+                self.log.info(f'Merging pr {num} to appid {app_id} from {author.__repr__()}!')
+                self.merge(repo, cat_file, num, app_id, author, app_info)
+            except:
+                traceback.print_exc()
+            else:
+                merged_list.append(num)
+                if type(num) is int:
+                    self.log.info(f'closing pr {num}!')
+                    self.close_pr(num)
+        cat_file.close()
+        repo.close()
+        return app_info, merged_list
 
     def merge_all(self):
+        app_pr_dict = {}
+        batch_dict = {}
+        cat_file = CatFile(self.repo.working_dir)
+        self.fetch([f'pull/{num}/head:origin_pr_{num}' for i in self.pr_list if (num := i['number']) and
+                    str(i['head']['ref']).startswith('batch_') and f'origin_pr_{num}' not in self.local_heads])
         for i in self.pr_list:
             try:
                 num, app_id = i['number'], str(i['head']['ref'])
+                if app_id.startswith('batch_'):
+                    author = self.get_author(i['user'])
+                    part_list = self.unpack_batch(cat_file, num)
+                    for app_id, part_num in part_list:
+                        app_pr_dict.setdefault(app_id, []).append((part_num, author))
+                    batch_dict[num] = (i['head'], [part_num for _, part_num in part_list])
+                    continue
                 if not app_id.isdecimal():
                     continue
-                self.author_name = i['user']['login']
-                user_id = i['user']['id']
-                if self.author_name:
-                    if not self.author_email:
-                        self.author_email = self.get_user_email()
-                    if not self.author_email:
-                        self.author_email = f'{user_id}+{self.author_name}@users.noreply.github.com'
-                self.log.info(
-                    f'Merging pr {num} to appid {app_id} from {git.Actor(self.author_name, self.author_email).__repr__()}!')
-                self.merge(num, app_id)
+                app_pr_dict.setdefault(app_id, []).append((num, self.get_author(i['user'])))
             except:
                 traceback.print_exc()
-            else:
-                self.log.info(f'closing pr {num}!')
+        cat_file.close()
+        self.local_heads = set(i.name for i in self.repo.heads)
+        self.fetch_all(app_pr_dict)
+        merged_set = set()
+        with Pool(self.pool_num) as pool:
+            result_list = [pool.apply_async(self.merge_app, i) for i in app_pr_dict.items()]
+            for result in result_list:
+                try:
+                    app_info, merged_list = result.get()
+                except:
+                    traceback.print_exc()
+                    continue
+                self.app_info.update(app_info)
+                merged_set.update(merged_list)
+        for num, (head, part_list) in batch_dict.items():
+            if all(i in merged_set for i in part_list):
+                self.log.info(f'closing batch pr {num}!')
                 self.close_pr(num)
+                # Branches of forks are deleted by pr.py on its next run, only branches of this repo can go now
+                if str(head.get('label')).split(':')[0] == self.repo_url.split('/')[0]:
+                    self.delete_branch(head['ref'])
+        if self.manifest_index is not None and self.manifest_index.commit():
+            self.journal.add(ManifestIndex.ref)
         self.app_info.dump()
 
-
 parser = argparse.ArgumentParser()
 parser.add_argument('-t', '--token')
 parser.add_argument('-l', '--level', default='INFO')
+parser.add_argument('-p', '--pool-num', type=int, default=8)
+parser.add_argument('-u', '--api-url', default='https://api.github.com')
+parser.add_argument('-g', '--graphql', action='store_true', default=False)
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    Merge(token=args.token, level=args.level).merge_all()
+    Merge(token=args.token, level=args.level, pool_num=args.pool_num, api_url=args.api_url,
+          graphql=args.graphql).merge_all()
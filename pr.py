@@ -2,14 +2,19 @@ import git
 import time
 import logging
 import argparse
-import requests
+import traceback
 from tqdm import tqdm
+from pathlib import Path
+from github import GitHub
+from catfile import CatFile
+from manifestindex import ManifestIndex
 
 
 class Pr:
     log = logging.getLogger('Pr')
 
-    def __init__(self, repo='.', source_repo=None, token=None, level=None):
+    def __init__(self, repo='.', source_repo=None, token=None, level=None, api_url=None, graphql=False,
+                 batch_size=0):
         if level:
             level = logging.getLevelName(level.upper())
         else:
@@ -20,39 +25,28 @@ class Pr:
         self.repo = git.Repo(repo)
         self.source_repo = source_repo
         self.add_source_repo()
-        self.headers = {'Accept': 'application/vnd.github+json',
-                        'Authorization': f'Bearer {token}', 'X-GitHub-Api-Version': '2022-11-28'}
+        self.github = GitHub(token, api_url=api_url, graphql=graphql)
         self.owner_name, self.repo_name = self.repo.remote().url.split('/')[-2:]
         self.source_owner_name, self.source_repo_name = self.repo.remote('source').url.split('/')[-2:]
-        self.origin_app_list, self.origin_tag_list = self.get_refs_list()
-        self.source_app_list, self.source_tag_list = self.get_refs_list(source_repo)
+        self.origin_app_dict, self.origin_tag_list = self.get_refs_list()
+        self.source_app_dict, self.source_tag_list = self.get_refs_list(source_repo)
         self.local_app_list = [int(i.name) for i in self.repo.heads if i.name.isdecimal()]
         self.diff_app_set = set()
         self.pr_list = []
+        self.pr_label_set = set()
+        self.batch_size = batch_size
 
     def get_all_pr(self):
         if self.pr_list:
             return self.pr_list
-        pr_list = []
-        page = 1
-        while True:
-            url = f'https://api.github.com/repos/{self.source_owner_name}/{self.source_repo_name}/pulls?per_page=100&page={page}'
-            r = requests.get(url, headers=self.headers)
-            if not r.json():
-                break
-            pr_list.extend(r.json())
-            page += 1
-        self.pr_list = pr_list
+        self.pr_list = self.github.get_all_pr(f'{self.source_owner_name}/{self.source_repo_name}')
+        self.pr_label_set = set(head.get('label') for pr in self.pr_list if (head := pr.get('head')))
         self.log.debug(str(self.pr_list))
         return self.pr_list
 
     def check_pr_exist(self, app_id):
-        for pr in self.get_all_pr():
-            if head := pr.get('head'):
-                if label := head.get('label'):
-                    if label == f'{self.source_owner_name}:{app_id}':
-                        return True
-        return False
+        self.get_all_pr()
+        return f'{self.source_owner_name}:{app_id}' in self.pr_label_set
 
     def add_source_repo(self):
         if not self.source_repo:
@@ -63,7 +57,7 @@ class Pr:
         self.repo.git.remote('add', 'source', self.source_repo)
 
     def get_refs_list(self, repo=None):
-        app_list = []
+        app_dict = {}
         tag_list = []
         if repo:
             result = self.repo.git.ls_remote(repo)
@@ -76,27 +70,47 @@ class Pr:
                 if refs.startswith('refs/heads/'):
                     if name.isdecimal():
                         app_id = int(name)
-                        app_list.append(app_id)
+                        app_dict[app_id] = sha
                 elif refs.startswith('refs/tags/'):
                     if '_' in name:
                         tag_list.append(name)
-        return app_list, tag_list
+        return app_dict, tag_list
 
-    def contains(self, tag):
-        try:
-            return self.repo.git.branch('-r', '--contains', tag).split('/')[-1]
-        except git.exc.GitCommandError:
-            pass
+    def get_tag_branch_dict(self):
+        commit_branch_dict = {}
+        for i in filter(None, self.repo.git.log('--source', '--remotes', '--format=%H %S').split('\n')):
+            sha, refs = i.split()
+            commit_branch_dict[sha] = refs.split('/')[-1]
+        tag_branch_dict = {}
+        for i in filter(None, self.repo.git.for_each_ref('--format=%(refname:short) %(objectname) %(*objectname)',
+                                                         'refs/tags').split('\n')):
+            tag, *sha_list = i.split()
+            if name := commit_branch_dict.get(sha_list[-1]):
+                tag_branch_dict[tag] = name
+        return tag_branch_dict
+
+    def check_diff_index(self):
+        origin_index = ManifestIndex(self.repo)
+        source_index = ManifestIndex(self.repo, load=False)
+        if not origin_index.fetch() or not source_index.fetch('source'):
+            return False
+        self.log.info(f'Comparing manifest indexes: {len(origin_index)} origin, {len(source_index)} source')
+        self.diff_app_set.update(i for i in origin_index.get_app_set(source_index) if i in self.origin_app_dict)
+        return True
 
     def check_diff(self):
-        for app_id in self.origin_app_list:
-            if app_id not in self.source_app_list:
+        for app_id in self.origin_app_dict:
+            if app_id not in self.source_app_dict:
                 self.diff_app_set.add(app_id)
+        if self.check_diff_index():
+            return
+        source_tag_set = set(self.source_tag_list)
+        tag_branch_dict = self.get_tag_branch_dict()
         self.tqdm = tqdm(total=len(self.origin_tag_list))
         for tag in self.origin_tag_list:
             self.tqdm.set_postfix(tag=tag, refresh=False)
-            if tag not in self.source_tag_list:
-                if name := self.contains(tag):
+            if tag not in source_tag_set:
+                if name := tag_branch_dict.get(tag):
                     if name.isdecimal():
                         app_id = int(name)
                         if app_id not in self.diff_app_set:
@@ -106,6 +120,88 @@ class Pr:
                     self.log.debug(f'Can\'t find the branch to which the tag belongs: {tag}')
             self.tqdm.update()
 
+    def get_open_batch_list(self):
+        return [label.split(':', 1)[1] for label in self.pr_label_set
+                if label and label.startswith(f'{self.owner_name}:batch_')]
+
+    def delete_batch_branch(self, open_batch_list):
+        # Batch branches outlive their pull requests, delete the ones whose pull requests are all closed
+        open_batch_set = set(open_batch_list)
+        delete_list = []
+        for i in filter(None, self.repo.git.ls_remote('--heads', 'origin', 'batch_*').split('\n')):
+            branch = i.split()[1][len('refs/heads/'):]
+            if branch in open_batch_set:
+                continue
+            pr_list = self.github.get(f'repos/{self.source_owner_name}/{self.source_repo_name}/pulls'
+                                      f'?state=all&head={self.owner_name}:{branch}')
+            if type(pr_list) is list and all(pr.get('state') == 'closed' for pr in pr_list):
+                delete_list.append(branch)
+        if delete_list:
+            self.log.info(f'Deleting {len(delete_list)} batch branches: {" ".join(delete_list)}')
+            self.repo.git.push('origin', '--delete', *delete_list)
+
+    def get_batch_app_set(self, branch_list):
+        app_set = set()
+        if not branch_list:
+            return app_set
+        self.repo.git.fetch('origin', *[f'+refs/heads/{i}:refs/remotes/origin/{i}' for i in branch_list])
+        with CatFile(self.repo.working_dir) as cat_file:
+            for branch in branch_list:
+                for binsha, mode, name in cat_file.tree(f'refs/remotes/origin/{branch}'):
+                    if name.isdecimal():
+                        app_set.add(int(name))
+        return app_set
+
+    def create_batch_branch(self, name, app_id_list):
+        # Use the exact origin heads listed by ls-remote and fetch the missing ones at once
+        with CatFile(self.repo.working_dir) as cat_file:
+            missing_list = [app_id for app_id in app_id_list if not cat_file.read(self.origin_app_dict[app_id])]
+        if missing_list:
+            self.repo.git.fetch('origin', *[f'+refs/heads/{app_id}:refs/remotes/origin/{app_id}'
+                                            for app_id in missing_list])
+        index_path = Path(self.repo.git_dir) / f'{name}.index'
+        env = {'GIT_INDEX_FILE': str(index_path)}
+        try:
+            self.repo.git.read_tree('--empty', env=env)
+            for app_id in app_id_list:
+                self.repo.git.read_tree(f'--prefix={app_id}/', f'{self.origin_app_dict[app_id]}^{{tree}}', env=env)
+            tree = self.repo.git.write_tree(env=env).strip()
+        finally:
+            index_path.unlink(missing_ok=True)
+        root = self.repo.git.rev_list('--max-parents=0', 'HEAD').split('\n')[0]
+        commit = self.repo.git.commit_tree(tree, '-p', root, '-m', f'Batch: {" ".join(map(str, app_id_list))}')
+        self.repo.git.push('origin', f'+{commit.strip()}:refs/heads/{name}')
+
+    def batch_pr(self, app_id_list):
+        open_batch_list = self.get_open_batch_list()
+        try:
+            self.delete_batch_branch(open_batch_list)
+        except:
+            self.log.error(f'Deleting batch branches failed: {traceback.format_exc()}')
+        batch_app_set = self.get_batch_app_set(open_batch_list)
+        app_id_list = sorted(i for i in app_id_list if i not in batch_app_set and i in self.origin_app_dict)
+        # Reuse the lowest batch_<n> names that no open pull request uses
+        num = 0
+        for i in range(0, len(app_id_list), self.batch_size):
+            chunk = app_id_list[i:i + self.batch_size]
+            while f'batch_{num}' in open_batch_list:
+                num += 1
+            name = f'batch_{num}'
+            num += 1
+            try:
+                self.create_batch_branch(name, chunk)
+                r = self.github.create_pr(f'{self.source_owner_name}/{self.source_repo_name}',
+                                          f'Batch: {len(chunk)} apps', f'{self.owner_name}:{name}', 'main',
+                                          ' '.join(map(str, chunk)))
+            except:
+                self.log.error(f'Creating batch pr {name} failed: {traceback.format_exc()}')
+                continue
+            if r.status_code == 201:
+                self.log.info(f'pr successfully: {name}, {len(chunk)} apps')
+                self.pr_label_set.add(f'{self.owner_name}:{name}')
+                continue
+            self.log.info(f'pr failed: {name}, result: {r.text}, headers: {r.headers}')
+
     def pr(self):
         self.check_diff()
         self.log.debug(str(self.diff_app_set))
@@ -115,33 +211,27 @@ class Pr:
                 self.log.info(f'app_id: {app_id}')
                 app_id_list.append(app_id)
         self.log.debug(str(app_id_list))
+        if self.batch_size:
+            return self.batch_pr(app_id_list)
         for app_id in app_id_list:
-            url = f'https://api.github.com/repos/{self.source_owner_name}/{self.source_repo_name}/pulls'
-            r = requests.post(url, headers=self.headers,
-                              json={'title': str(app_id), 'head': f'{self.owner_name}:{app_id}', 'base': 'main'})
+            r = self.github.create_pr(f'{self.source_owner_name}/{self.source_repo_name}', str(app_id),
+                                      f'{self.owner_name}:{app_id}', 'main')
             if r.status_code == 201:
                 self.log.info(f'pr successfully: {app_id}')
-                time.sleep(15)
+                self.pr_label_set.add(f'{self.source_owner_name}:{app_id}')
                 continue
             self.log.info(f'pr failed: {app_id}, result: {r.text}, headers: {r.headers}')
-            if r.status_code == 403 and 'x-ratelimit-reset' in r.headers:
-                t = int(r.headers['x-ratelimit-reset'])
-                now = int(time.time())
-                if now < t:
-                    count = t - now
-                    self.log.info(f'Wait {count} second!')
-                    while count:
-                        time.sleep(1)
-                        count -= 1
-                        self.log.debug(f'Wait {count} second!')
-            time.sleep(15)
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-r', '--repo', default='https://github.com/wxy1343/ManifestAutoUpdate')
 parser.add_argument('-t', '--token')
 parser.add_argument('-l', '--level', default='INFO')
+parser.add_argument('-u', '--api-url', default='https://api.github.com')
+parser.add_argument('-g', '--graphql', action='store_true', default=False)
+parser.add_argument('-b', '--batch-size', type=int, default=0)
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    Pr(source_repo=args.repo, token=args.token, level=args.level).pr()
+    Pr(source_repo=args.repo, token=args.token, level=args.level, api_url=args.api_url, graphql=args.graphql,
+       batch_size=args.batch_size).pr()
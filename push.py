@@ -1,16 +1,131 @@
+import os
 import git
 import time
+import argparse
 import traceback
 import subprocess
 from pathlib import Path
 from git import GitCommandError
-from multiprocessing.pool import ThreadPool
-from multiprocessing.dummy import Pool, Lock
+from multiprocessing.dummy import Lock
 
-lock = Lock()
 
+class PushJournal:
+    full_interval = 604800
 
-def push(repo=None):
+    def __init__(self, path='data'):
+        # Kept in the data worktree so pending refs and the last full push survive fresh clones
+        self.path = Path(path) / 'push_journal'
+        self.full_path = Path(path) / 'push_full'
+        self.lock = Lock()
+
+    def add(self, *refs_list):
+        with self.lock:
+            with self.path.open('a') as f:
+                f.write(''.join(f'{refs}\n' for refs in refs_list))
+
+    def load(self):
+        if not self.path.exists():
+            return []
+        with self.path.open() as f:
+            return list(dict.fromkeys(filter(None, f.read().split('\n'))))
+
+    def reset(self, done_list, failed_list=None):
+        done_set = set(done_list)
+        with self.lock:
+            refs_list = [i for i in self.load() if i not in done_set]
+            refs_list.extend(i for i in failed_list or [] if i not in refs_list)
+            tmp_path = self.path.with_suffix('.tmp')
+            with tmp_path.open('w') as f:
+                f.write(''.join(f'{refs}\n' for refs in refs_list))
+            os.replace(tmp_path, self.path)
+
+    def need_full(self):
+        try:
+            last_full_time = int(self.full_path.read_text().strip())
+        except (OSError, ValueError):
+            return True
+        return time.time() - last_full_time > self.full_interval
+
+    def mark_full(self):
+        self.full_path.write_text(str(int(time.time())))
+
+
+def get_remote_refs(repo):
+    remote_head_dict = {}
+    remote_tag_set = set()
+    for i in filter(None, repo.git.ls_remote('origin').split('\n')):
+        sha, refs = i.split()
+        if refs.startswith('refs/heads/') or refs.startswith('refs/meta/'):
+            remote_head_dict[refs] = sha
+        elif refs.startswith('refs/tags/'):
+            remote_tag_set.add(refs[:-3] if refs.endswith('^{}') else refs)
+    return remote_head_dict, remote_tag_set
+
+
+def push_refs(repo, refs_list, atomic=False, chunk_size=200):
+    retry_list = []
+    rejected_list = []
+    for i in range(0, len(refs_list), chunk_size):
+        chunk = refs_list[i:i + chunk_size]
+        args = ['git', 'push', '--porcelain']
+        if atomic:
+            args.append('--atomic')
+        args.extend(['origin', *[f'{refs}:{refs}' for refs in chunk]])
+        result = subprocess.run(args, cwd=repo.working_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        status_dict = {}
+        for line in result.stdout.split('\n'):
+            line = line.split('\t')
+            if len(line) >= 3 and ':' in line[1]:
+                status_dict[line[1].split(':')[-1]] = (line[0], line[2])
+        for refs in chunk:
+            flag, summary = status_dict.get(refs, ('!', ''))
+            if flag != '!':
+                continue
+            if summary.startswith(('[rejected]', '[remote rejected]')) and 'atomic push failed' not in summary:
+                rejected_list.append(refs)
+            else:
+                retry_list.append(refs)
+        if result.returncode and result.stderr:
+            print(result.stderr.strip())
+    return retry_list, rejected_list
+
+
+def get_local_refs(repo):
+    local_refs_dict = {}
+    for i in filter(None, repo.git.for_each_ref('--format=%(objectname) %(refname)', 'refs/heads', 'refs/tags',
+                                                'refs/meta').split('\n')):
+        sha, refs = i.split()
+        local_refs_dict[refs] = sha
+    return local_refs_dict
+
+
+def get_changed_refs(repo, app_sha=None, journal_list=None):
+    if journal_list is None:
+        remote_head_dict, remote_tag_set = get_remote_refs(repo)
+    else:
+        remote_head_dict, remote_tag_set = {}, set()
+    local_refs_dict = get_local_refs(repo)
+    branch_list = []
+    tag_list = []
+    for refs in local_refs_dict if journal_list is None else journal_list:
+        if not (sha := local_refs_dict.get(refs)):
+            continue
+        name = refs.split('/', 2)[2]
+        if refs.startswith('refs/heads/'):
+            if name.isdecimal() and remote_head_dict.get(refs) != sha and sha != app_sha:
+                branch_list.append(refs)
+                print(name, sha)
+        elif refs.startswith('refs/tags/') and refs not in remote_tag_set:
+            tag_list.append(refs)
+            print(name, sha)
+        elif refs.startswith('refs/meta/') and remote_head_dict.get(refs) != sha:
+            branch_list.append(refs)
+            print(name, sha)
+    return branch_list, tag_list
+
+
+def push(repo=None, atomic=False, retry_num=3, full=False):
     if not repo:
         repo = git.Repo()
     app_sha = None
@@ -18,58 +133,30 @@ def push(repo=None):
         app_sha = repo.git.rev_parse('app').strip()
     except GitCommandError:
         pass
-    remote_head_list = []
-    remote_tag_list = []
-    for i in repo.git.ls_remote('origin').split('\n'):
-        sha, refs = i.split()
-        if refs.startswith('refs/heads/'):
-            head = refs.split('/')[2]
-            if head.isdecimal():
-                remote_head_list.append((sha, head))
-        elif refs.startswith('refs/tags/'):
-            tag = refs.split('/')[2]
-            remote_tag_list.append((sha, tag))
-    total_branch = 0
-    total_tag = 0
-    with Pool(8) as pool:
-        pool: ThreadPool
-        result_list = []
-        for local_head in repo.heads:
-            if local_head.name.isdecimal():
-                for remote_sha, remote_head in remote_head_list:
-                    if local_head.name == remote_head and local_head.commit.hexsha == remote_sha:
-                        break
-                else:
-                    if local_head.commit.hexsha == app_sha:
-                        continue
-                    total_branch += 1
-                    with lock:
-                        print(local_head.name, local_head.commit.hexsha)
-                    result_list.append(
-                        pool.map_async(subprocess.check_call, (['git', 'push', 'origin', local_head.name],)))
-        for local_tag in repo.tags:
-            for remote_sha, remote_tag in remote_tag_list:
-                if remote_tag == local_tag.name:
-                    break
-            else:
-                total_tag += 1
-                with lock:
-                    print(local_tag.name, local_tag.commit.hexsha)
-                result_list.append(pool.map_async(subprocess.check_call, (['git', 'push', 'origin', local_tag.name],)))
-        try:
-            while pool._state == 'RUN':
-                if all([result.ready() for result in result_list]):
-                    break
-                time.sleep(1)
-        except KeyboardInterrupt:
-            pass
-        finally:
-            with lock:
-                pool.terminate()
-    print(f'Pushed {total_branch} branch!')
-    print(f'Pushed {total_tag} tag!')
-    if not all([result.successful() for result in result_list]):
-        return push(repo=repo)
+    journal = PushJournal(Path(repo.working_dir) / 'data')
+    journal_list = journal.load()
+    full = full or journal.need_full()
+    if full:
+        print('Pushing all changed refs!')
+    branch_list, tag_list = get_changed_refs(repo, app_sha, None if full else journal_list)
+    refs_list = branch_list + tag_list
+    failed_list = []
+    while refs_list and retry_num:
+        refs_list, rejected_list = push_refs(repo, refs_list, atomic)
+        failed_list.extend(rejected_list)
+        retry_num -= 1
+    # Only transport failures stay in the journal, a ref the remote rejects would be rejected again on every run
+    journal.reset(journal_list, refs_list)
+    if full:
+        journal.mark_full()
+    if refs_list:
+        print(f'Failed to push {len(refs_list)} refs: {" ".join(refs_list)}')
+    if failed_list:
+        print(f'Remote rejected {len(failed_list)} refs: {" ".join(failed_list)}')
+    refs_list.extend(failed_list)
+    print(f'Pushed {len(branch_list) - len([i for i in refs_list if not i.startswith("refs/tags/")])} branch!')
+    print(f'Pushed {len(tag_list) - len([i for i in refs_list if i.startswith("refs/tags/")])} tag!')
+    return not refs_list
 
 
 def push_data(repo=None):
@@ -81,13 +168,24 @@ def push_data(repo=None):
     except git.exc.GitCommandError:
         pass
     try:
-        file_list = ['appinfo.json', 'userinfo.json', 'users.json', '2fa.json', 'apps.xlsx']
+        repo.git.add('client/cm_rank.json')
+    except git.exc.GitCommandError:
+        pass
+    try:
+        file_list = ['appinfo.json', 'userinfo.json', 'users.json', '2fa.json', 'apps.xlsx', 'github_email.json',
+                     'push_journal', 'push_full']
         for i in file_list:
             path = Path('data') / i
             if path.is_file():
                 repo.git.add(path.name)
     except git.exc.GitCommandError:
         traceback.print_exc()
+    try:
+        # Binary caches churn on every run, the key store is rebuilt from the config.vdf of every branch and the
+        # GitHub response cache belongs to the Actions cache
+        repo.git.rm('--cached', '--ignore-unmatch', '-q', 'depotkeys.db', 'github.db')
+    except git.exc.GitCommandError:
+        traceback.print_exc()
     try:
         repo.git.commit('-m', 'update')
         repo.git.push('origin', 'data')
@@ -95,6 +193,12 @@ def push_data(repo=None):
         traceback.print_exc()
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument('-a', '--atomic', action='store_true', default=False)
+parser.add_argument('-r', '--retry-num', type=int, default=3)
+parser.add_argument('-f', '--full', action='store_true', default=False)
+
 if __name__ == '__main__':
-    push()
+    args = parser.parse_args()
+    push(atomic=args.atomic, retry_num=args.retry_num, full=args.full)
     push_data()
@@ -1,13 +1,14 @@
 import os
 import vdf
 import time
-import shutil
 import winreg
 import sqlite3
 import argparse
 import requests
 import traceback
+from io import BytesIO
 from pathlib import Path
+from zipfile import ZipFile
 from multiprocessing.pool import ThreadPool
 from multiprocessing.dummy import Pool, Lock
 
@@ -32,23 +33,35 @@ def get(sha, path):
                     raise
 
 
-def get_manifest(sha, path, steam_path: Path, app_id=None):
+def decompress(content):
+    if content[:2] == b'PK':
+        with ZipFile(BytesIO(content)) as zf:
+            return zf.read(zf.filelist[0])
+    return content
+
+
+def get_manifest(sha, path, steam_path: Path, app_id=None, name=None):
     try:
         if path.endswith('.manifest'):
+            name = name or path
             depot_cache_path = steam_path / 'depotcache'
             with lock:
                 if not depot_cache_path.exists():
                     depot_cache_path.mkdir(exist_ok=True)
-            save_path = depot_cache_path / path
+            save_path = depot_cache_path / name
             if save_path.exists():
                 with lock:
-                    print(f'已存在清单: {path}')
+                    print(f'已存在清单: {name}')
                 return
-            content = get(sha, path)
+            content = decompress(get(sha, path))
             with lock:
-                print(f'清单下载成功: {path}')
+                print(f'清单下载成功: {name}')
             with save_path.open('wb') as f:
                 f.write(content)
+        elif path == 'alias.txt':
+            # Content-identical manifests are stored once, save the existing file under the current manifest's name
+            for name, target in load_alias(get(sha, path).decode()).items():
+                get_manifest(sha, f'{target}.manifest', steam_path, app_id, f'{name}.manifest')
         elif path == 'config.vdf':
             content = get(sha, path)
             with lock:
@@ -68,6 +81,10 @@ def get_manifest(sha, path, steam_path: Path, app_id=None):
     return True
 
 
+def load_alias(data):
+    return dict(i.split() for i in data.split('\n') if i)
+
+
 def depotkey_merge(config_path, depots_config):
     if not config_path.exists():
         with lock:
@@ -148,12 +165,22 @@ def app(app_path):
         stool_add([(app_id, '1', None)])
     else:
         raise Exception('目录名称不是app_id')
+    depot_cache_path = steam_path / 'depotcache'
     for file in app_path.iterdir():
         if file.is_file():
             if file.suffix == '.manifest':
-                depot_cache_path = steam_path / 'depotcache'
-                shutil.copy(file, depot_cache_path)
+                with file.open('rb') as f, (depot_cache_path / file.name).open('wb') as f_out:
+                    f_out.write(decompress(f.read()))
                 print(f'导入清单成功: {file.name}')
+            elif file.name == 'alias.txt':
+                for name, target in load_alias(file.read_text()).items():
+                    target_path = app_path / f'{target}.manifest'
+                    if not target_path.is_file():
+                        print(f'清单不存在: {target_path.name}')
+                        continue
+                    with target_path.open('rb') as f, (depot_cache_path / f'{name}.manifest').open('wb') as f_out:
+                        f_out.write(decompress(f.read()))
+                    print(f'导入清单成功: {name}.manifest')
             elif file.name == 'config.vdf':
                 with file.open('r', encoding='utf-8') as f:
                     depots_config = vdf.loads(f.read())